@@ -2,6 +2,36 @@
 #--web true
 #--param OLLAMA_API_HOST "$OLLAMA_API_HOST"
 #--param OLLAMA_CHAT_MODEL "$OLLAMA_CHAT_MODEL"
+#--param OLLAMA_POOL_SIZE "$OLLAMA_POOL_SIZE"
+#--param OLLAMA_CONNECT_TIMEOUT "$OLLAMA_CONNECT_TIMEOUT"
+#--param OLLAMA_READ_TIMEOUT "$OLLAMA_READ_TIMEOUT"
+#--param OLLAMA_HEALTH_INTERVAL "$OLLAMA_HEALTH_INTERVAL"
+#--param OLLAMA_KEEP_ALIVE "$OLLAMA_KEEP_ALIVE"
+#--param OLLAMA_HOT_MODELS "$OLLAMA_HOT_MODELS"
+#--param OLLAMA_FIRST_TOKEN_TIMEOUT "$OLLAMA_FIRST_TOKEN_TIMEOUT"
+#--param OLLAMA_TOKEN_TIMEOUT "$OLLAMA_TOKEN_TIMEOUT"
+#--param CHAT_MAX_TIME "$CHAT_MAX_TIME"
+#--param CHAT_MAX_TOKENS "$CHAT_MAX_TOKENS"
+#--param CHAT_ADMISSION "$CHAT_ADMISSION"
+#--param CHAT_MAX_RUNNING "$CHAT_MAX_RUNNING"
+#--param CHAT_USER_CONCURRENCY "$CHAT_USER_CONCURRENCY"
+#--param CHAT_USER_TOKENS_PER_MIN "$CHAT_USER_TOKENS_PER_MIN"
+#--param CHAT_QUEUE_SIZE "$CHAT_QUEUE_SIZE"
+#--param CHAT_QUEUE_WAIT "$CHAT_QUEUE_WAIT"
+#--param CHAT_ROUTER_TIERS "$CHAT_ROUTER_TIERS"
+#--param CHAT_ROUTER_LIMITS "$CHAT_ROUTER_LIMITS"
+#--param CHAT_SEMANTIC_CACHE "$CHAT_SEMANTIC_CACHE"
+#--param CHAT_SEMANTIC_MODEL "$CHAT_SEMANTIC_MODEL"
+#--param CHAT_SEMANTIC_THRESHOLD "$CHAT_SEMANTIC_THRESHOLD"
+#--param CHAT_SEMANTIC_TTL "$CHAT_SEMANTIC_TTL"
+#--param STREAM_FRAMING "$STREAM_FRAMING"
+#--param STREAM_DEBUG "$STREAM_DEBUG"
+#--param STREAM_MUX "$STREAM_MUX"
+#--param REDIS_URL "$REDIS_URL"
+#--param REDIS_PREFIX "$REDIS_PREFIX"
+#--param MILVUS_HOST "$MILVUS_HOST"
+#--param MILVUS_DB_NAME "$MILVUS_DB_NAME"
+#--param MILVUS_TOKEN "$MILVUS_TOKEN"
 
 import chat
 def main(args):
@@ -0,0 +1,230 @@
+import time, math, secrets
+import rdb
+
+# admission control of the generations, shared by all the containers through redis.
+# each user can have at most CHAT_USER_CONCURRENCY requests running or waiting,
+# and spends tokens from a budget refilled at CHAT_USER_TOKENS_PER_MIN.
+# at most CHAT_MAX_RUNNING generations run at the same time, the others wait in a queue
+# ordered by round: the k-th waiting request of a user goes after the (k-1)-th of every other user,
+# so a burst of one user does not delay the others.
+# when the queue is full, or the wait would be longer than CHAT_QUEUE_WAIT,
+# the request is refused at once with "busy, retry in N s".
+# the user is the one of the login token ("user:secret"), verified against TOKEN:<user> in redis
+# as the other web actions do, else the session.
+
+MAX_RUNNING = 8
+USER_CONCURRENCY = 2
+QUEUE_SIZE = 32
+QUEUE_WAIT = 20.0
+LEASE = 300.0
+POLL = 0.1
+STALE = 5.0
+# expected duration of a generation until it is measured
+SECONDS = 10.0
+ALPHA = 0.2
+
+RUNNING = 0
+USER_LIMIT = -1
+QUEUE_FULL = -2
+
+# returns RUNNING when admitted, the position in the queue when waiting, or a refusal
+# KEYS: running, user running, queue, user waiting, last polls, sequence
+# ARGV: ticket, now, lease, max running, max per user, max queue, stale
+ACQUIRE = """
+local now = tonumber(ARGV[2])
+local stale = now - tonumber(ARGV[7])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+redis.call('zremrangebyscore', KEYS[4], '-inf', stale)
+for _, t in ipairs(redis.call('zrangebyscore', KEYS[5], '-inf', stale)) do
+  redis.call('zrem', KEYS[3], t)
+  redis.call('zrem', KEYS[5], t)
+end
+local ticket = ARGV[1]
+if not redis.call('zscore', KEYS[3], ticket) then
+  if redis.call('zcard', KEYS[2]) + redis.call('zcard', KEYS[4]) >= tonumber(ARGV[5]) then
+    return -1
+  end
+  if redis.call('zcard', KEYS[3]) >= tonumber(ARGV[6]) then
+    return -2
+  end
+  local round = redis.call('zcard', KEYS[4])
+  local seq = redis.call('incr', KEYS[6]) % 1e12
+  redis.call('zadd', KEYS[3], string.format('%.0f', round * 1e12 + seq), ticket)
+end
+redis.call('zadd', KEYS[4], now, ticket)
+redis.call('zadd', KEYS[5], now, ticket)
+local rank = redis.call('zrank', KEYS[3], ticket)
+if rank == 0 and redis.call('zcard', KEYS[1]) < tonumber(ARGV[4]) then
+  redis.call('zrem', KEYS[3], ticket)
+  redis.call('zrem', KEYS[4], ticket)
+  redis.call('zrem', KEYS[5], ticket)
+  local expiry = now + tonumber(ARGV[3])
+  redis.call('zadd', KEYS[1], expiry, ticket)
+  redis.call('zadd', KEYS[2], expiry, ticket)
+  return 0
+end
+return rank + 1
+"""
+
+# token bucket: refill, take ARGV[4] tokens and return what is left (can go negative)
+# KEYS: bucket
+# ARGV: now, rate per second, burst, cost
+SPEND = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('hget', KEYS[1], 'tokens') or burst)
+local ts = tonumber(redis.call('hget', KEYS[1], 'ts') or now)
+tokens = math.min(burst, tokens + (now - ts) * rate) - tonumber(ARGV[4])
+redis.call('hset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(tokens)
+"""
+
+def enabled(args):
+  return str(args.get("CHAT_ADMISSION", "true")).lower() not in ["0", "false", "no"]
+
+def user(args, session=""):
+  (name, _, secret) = (args.get("token") or "").partition(":")
+  if name and secret:
+    (rd, prefix) = rdb.connect(args)
+    try:
+      check = rd.get(f"{prefix}TOKEN:{name}") if rd else None
+      if check and secrets.compare_digest(check, secret.encode("utf-8")):
+        return name
+    except Exception as e:
+      print("admission:", e)
+  return session or "anonymous"
+
+def options(args):
+  def opt(key, default):
+    return float(args.get(key) or default)
+  return {
+    "running": int(opt("CHAT_MAX_RUNNING", MAX_RUNNING)),
+    "user": int(opt("CHAT_USER_CONCURRENCY", USER_CONCURRENCY)),
+    "queue": int(opt("CHAT_QUEUE_SIZE", QUEUE_SIZE)),
+    "wait": opt("CHAT_QUEUE_WAIT", QUEUE_WAIT),
+    # no time limit (0) is the default lease, not a lease already expired
+    "lease": opt("CHAT_MAX_TIME", LEASE) if opt("CHAT_MAX_TIME", LEASE) > 0 else LEASE,
+    "rate": opt("CHAT_USER_TOKENS_PER_MIN", 0) / 60
+  }
+
+def names(prefix, user):
+  return [f"{prefix}ADMIT:running", f"{prefix}ADMIT:running:{user}", f"{prefix}ADMIT:queue",
+          f"{prefix}ADMIT:waiting:{user}", f"{prefix}ADMIT:polls", f"{prefix}ADMIT:seq"]
+
+def spend(rd, prefix, user, opts, cost):
+  bucket = f"{prefix}ADMIT:tokens:{user}"
+  burst = opts["rate"] * 60
+  return float(rd.eval(SPEND, 1, bucket, time.time(), opts["rate"], burst, cost))
+
+def seconds(rd, prefix):
+  value = rd.get(f"{prefix}ADMIT:seconds")
+  return float(value) if value else SECONDS
+
+def busy(retry):
+  return f"Busy, retry in {max(1, math.ceil(retry))} s.\n"
+
+def cancel(rd, keys, ticket):
+  pipe = rd.pipeline()
+  for key in keys[2:5]:
+    pipe.zrem(key, ticket)
+  pipe.execute()
+
+def admit(args, user):
+  """
+  Wait for a slot, return (ticket, None) when admitted or (None, message) when refused.
+  The ticket is None also when admission control is disabled.
+  """
+  (rd, prefix) = rdb.connect(args)
+  if not rd or not enabled(args):
+    return (None, None)
+  opts = options(args)
+  keys = names(prefix, user)
+  ticket = f"{user}:{secrets.token_hex(8)}"
+  try:
+    if opts["rate"] > 0:
+      left = spend(rd, prefix, user, opts, 0)
+      if left <= 0:
+        return (None, busy((1 - left) / opts["rate"]))
+    avg = seconds(rd, prefix)
+    deadline = time.time() + opts["wait"]
+    while True:
+      now = time.time()
+      res = rd.eval(ACQUIRE, len(keys), *keys, ticket, now, opts["lease"],
+                    opts["running"], opts["user"], opts["queue"], STALE)
+      if res == RUNNING:
+        return (ticket, None)
+      if res == USER_LIMIT:
+        return (None, busy(avg))
+      # expected wait: the requests ahead share the running slots
+      ahead = opts["queue"] if res == QUEUE_FULL else res
+      retry = ahead / max(1, opts["running"]) * avg
+      if res == QUEUE_FULL or now + retry > deadline or now > deadline:
+        cancel(rd, keys, ticket)
+        return (None, busy(retry))
+      time.sleep(POLL)
+  except Exception as e:
+    # without redis the requests are not limited
+    print("admission:", e)
+    return (None, None)
+
+def release(args, user, ticket, tokens, elapsed):
+  (rd, prefix) = rdb.connect(args)
+  if not rd or not ticket:
+    return
+  opts = options(args)
+  keys = names(prefix, user)
+  try:
+    pipe = rd.pipeline()
+    pipe.zrem(keys[0], ticket)
+    pipe.zrem(keys[1], ticket)
+    pipe.set(f"{prefix}ADMIT:seconds", (1 - ALPHA) * seconds(rd, prefix) + ALPHA * elapsed)
+    pipe.execute()
+    if opts["rate"] > 0 and tokens:
+      spend(rd, prefix, user, opts, tokens)
+  except Exception as e:
+    print("admission:", e)
+
+def admitted(args, user, generate):
+  """
+  The lines of generate() once admitted, or the refusal.
+  """
+  (ticket, refused) = admit(args, user)
+  if refused:
+    return [refused]
+  return Admitted(args, user, ticket, generate())
+
+class Admitted:
+  """
+  Pass through the lines of an admitted generation,
+  then free the slot and charge the tokens to the user.
+  """
+  def __init__(self, args, user, ticket, lines):
+    self.args = args
+    self.user = user
+    self.ticket = ticket
+    self.lines = lines
+    self.tokens = 0
+    self.start = time.time()
+
+  def __iter__(self):
+    try:
+      for line in self.lines:
+        self.tokens += 1
+        yield line
+    finally:
+      self.release()
+
+  def release(self):
+    if self.ticket:
+      (ticket, self.ticket) = (self.ticket, None)
+      release(self.args, self.user, ticket, self.tokens, time.time() - self.start)
+
+  def close(self):
+    try:
+      if hasattr(self.lines, "close"):
+        self.lines.close()
+    finally:
+      self.release()
@@ -0,0 +1,153 @@
+import os, time, socket, threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import client
+
+# OLLAMA_API_HOST can be a comma separated list of backends.
+# each request goes to the healthy backend having the model with less requests in flight;
+# backends are checked every INTERVAL seconds (on demand, when a request arrives),
+# and a generation fails over to another backend if it fails before the first token.
+
+INTERVAL = 10
+CHECK_TIMEOUT = 2
+
+backends = {}
+checked = 0.0
+lock = threading.Lock()
+
+def hosts(args):
+  value = args.get("OLLAMA_API_HOST", os.getenv("OLLAMA_API_HOST", ""))
+  return [host.strip().rstrip("/") for host in value.split(",") if host.strip()]
+
+def backend(host):
+  with lock:
+    if host not in backends:
+      backends[host] = {"healthy": True, "models": None, "inflight": 0, "requests": 0, "errors": 0}
+    return backends[host]
+
+def probe(args, host):
+  b = backend(host)
+  try:
+    data = client.connect(args).get(f"{host}/api/tags", timeout=CHECK_TIMEOUT).json()
+    b["models"] = set(model.get("name", "") for model in data.get("models", []))
+    b["healthy"] = True
+  except Exception as e:
+    print(f"balancer: {host} unhealthy: {e}")
+    b["healthy"] = False
+
+def check(args, force=False):
+  global checked
+  hs = hosts(args)
+  interval = float(client.env(args, "OLLAMA_HEALTH_INTERVAL", INTERVAL))
+  now = time.time()
+  # with one backend there is nothing to choose
+  if len(hs) > 1 and (force or now - checked >= interval):
+    checked = now
+    with ThreadPoolExecutor(max_workers=len(hs)) as pool:
+      list(pool.map(lambda host: probe(args, host), hs))
+  return hs
+
+def error_rate(b):
+  return b["errors"] / b["requests"] if b["requests"] else 0.0
+
+def choose(args, model=None, exclude=()):
+  """
+  Return the least loaded healthy backend having the model, None if all are excluded.
+  """
+  hs = [host for host in check(args) if host not in exclude]
+  if not hs:
+    return None
+  def usable(host):
+    b = backend(host)
+    return b["healthy"] and (model is None or b["models"] is None or model in b["models"])
+  # if nobody looks usable, try anyway
+  candidates = [host for host in hs if usable(host)] or hs
+  return min(candidates, key=lambda host: (backend(host)["inflight"], error_rate(backend(host))))
+
+def begin(host):
+  b = backend(host)
+  with lock:
+    b["inflight"] += 1
+    b["requests"] += 1
+
+def end(host, error=False):
+  b = backend(host)
+  with lock:
+    b["inflight"] -= 1
+    if error:
+      b["errors"] += 1
+      b["healthy"] = False
+
+class Lines:
+  """
+  The lines of a streaming post to the best backend, the request is sent when the iteration starts.
+  Unlike the generator from iter_lines, close() works also while another thread
+  is blocked reading it.
+  """
+  def __init__(self, args, cmd, model, **kwargs):
+    self.args = args
+    self.cmd = cmd
+    self.model = model
+    self.kwargs = kwargs
+    self.resp = None
+    self.closed = False
+
+  def __iter__(self):
+    tried = []
+    error = None
+    while True:
+      host = choose(self.args, self.model, tried)
+      if host is None:
+        raise error or requests.ConnectionError("no backend available")
+      tried.append(host)
+      begin(host)
+      try:
+        self.resp = client.post(self.args, f"{host}/api/{self.cmd}", stream=True, **self.kwargs)
+        if self.resp.status_code >= 500:
+          raise requests.HTTPError(f"{host}: {self.resp.status_code}", response=self.resp)
+        lines = self.resp.iter_lines()
+        first = next(lines, None)
+      except requests.RequestException as e:
+        if self.resp is not None:
+          self.resp.close()
+        if self.closed:
+          # closed by the consumer while waiting for the first line
+          end(host, False)
+          return
+        # nothing was sent downstream yet, try another backend
+        print(f"balancer: failover from {host}: {e}")
+        end(host, True)
+        error = e
+        continue
+      failed = False
+      try:
+        if first is not None:
+          yield first
+        yield from lines
+      except GeneratorExit:
+        # closed by the consumer, not a backend failure
+        raise
+      except Exception:
+        failed = not self.closed
+        raise
+      finally:
+        end(host, failed)
+      return
+
+  def close(self):
+    self.closed = True
+    if self.resp is not None:
+      # close() alone does not wake a thread blocked reading the socket, shutdown() does
+      try:
+        self.resp.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+      except (AttributeError, OSError):
+        pass
+      self.resp.close()
+
+def report():
+  out = ""
+  for host in list(backends):
+    b = backend(host)
+    status = "up" if b["healthy"] else "down"
+    out += f"{host} {status} inflight: {b['inflight']} requests: {b['requests']} errors: {b['errors']} ({error_rate(b):.0%})\n"
+  return out
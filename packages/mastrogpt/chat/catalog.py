@@ -0,0 +1,46 @@
+import time, bisect
+import client
+
+# cached list of the models in /api/tags of all the backends, sorted to search prefixes by bisection
+
+TTL = 60
+
+names = []
+expires = 0.0
+
+def invalidate():
+  global expires
+  expires = 0.0
+
+def load(args, apis):
+  global names, expires
+  now = time.time()
+  if now >= expires:
+    found = set()
+    for api in apis:
+      try:
+        data = client.get(args, api).json()
+        found.update(model.get("name", "") for model in data.get("models", []))
+      except Exception as e:
+        # the other backends can still answer
+        print("catalog:", e)
+        if len(apis) == 1:
+          raise
+    names = sorted(found)
+    ttl = float(client.env(args, "OLLAMA_MODELS_TTL", TTL))
+    expires = now + ttl
+  return names
+
+def matches(names, prefix):
+  """
+  Return the names starting with prefix, in O(log n) + the number of matches.
+  """
+  start = bisect.bisect_left(names, prefix)
+  end = start
+  while end < len(names) and names[end].startswith(prefix):
+    end += 1
+  return names[start:end]
+
+def select(names, prefix):
+  found = matches(names, prefix)
+  return found[0] if found else None
@@ -1,78 +1,181 @@
-import os, requests as req, json
-import socket, traceback, time
+import os, json
+import traceback, asyncio
+import requests
+import client, balancer, catalog, pipeline, respcache, sessions, singleflight, residency, meter, guard, admission, router, mux
+from writer import FrameWriter, options as frame_options
 
-def url(args, cmd):
-  apihost = args.get("OLLAMA_API_HOST", os.getenv("OLLAMA_API_HOST", ""))
+def url(args, cmd, model=None):
+  apihost = balancer.choose(args, model) or ""
   return f"{apihost}/api/{cmd}"
 
-def stream(args, lines, state=None):
+def urls(args, cmd):
+  return [f"{apihost}/api/{cmd}" for apihost in balancer.hosts(args)]
+
+def parse(line):
+  msg = {}
   out = ""
-  sock = None
+  # parse lines, cah be
+  # a string
+  # { "response" : ...} 
+  # { "state": .. }
+  # { "error": ...} from ollama
+  try:
+    jo = json.loads(line.decode("utf-8"))
+    if "state" in jo:
+      msg["state"] =  jo.get("state", "")
+    if "response" in jo:
+      out = jo.get("response", "")
+      msg["output"] = out
+    if "error" in jo:
+      out = f"Error: {jo['error']}\n"
+      msg["output"] = out
+  except:
+    if isinstance(line, bytes):
+      line = line.decode("utf-8", "replace")
+    msg["output"] = line 
+    out = line
+  return (msg, out)
+
+async def astream(args, lines, state=None):
+  opts = pipeline.options(args)
   addr = (args.get("STREAM_HOST", ""),int(args.get("STREAM_PORT") or "0"))
-  if addr[0] and addr:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-    sock.connect(addr)
-    print(addr, sock)
-    if state:
-      buf = json.dumps(state).encode("utf-8")
-      #print(buf)
-      sock.sendall(buf)
-      time.sleep(0.01)  # give some time to process the state
-
-  for line in lines:
-    msg = {}
-    # parse lines, cah be
-    # a string
-    # { "response" : ...} 
-    # { "state": .. }
+  (_, session) = sessions.split((state or {}).get("state", ""))
+  limits = guard.Guard(args, session)
+
+  async def consume(queue):
+    out = []
+    writer = None
+    reader = None
+    closed = None
+    if addr[0] and addr[1] and mux.enabled(args):
+      # a channel on the connection kept by the container, the state is acknowledged
+      sink = await asyncio.to_thread(mux.Channel, addr, opts["connect"])
+      closed = sink.closed
+      writer = FrameWriter(sink, **frame_options(args), channel=sink.id)
+      writer.send(state or {"state": ""})
+      if not await asyncio.to_thread(sink.acked.wait, opts["ack"]):
+        print(f"mux: no ack for {sink.id}")
+    elif addr[0] and addr[1]:
+      (reader, conn) = await asyncio.wait_for(asyncio.open_connection(*addr), opts["connect"])
+      print(addr, conn)
+      sink = pipeline.Sink(conn, opts["send"])
+      writer = FrameWriter(sink, **frame_options(args))
+      if state:
+        writer.send(state)
+        await sink.drain()
+        await asyncio.sleep(0.01)  # give some time to process the state
+    watcher = asyncio.create_task(limits.watch(reader, closed))
+    stopped = asyncio.create_task(limits.stopped.wait())
     try:
-      jo = json.loads(line.decode("utf-8"))
-      if "state" in jo:
-        msg["state"] =  jo.get("state", "")
-      if "response" in jo:
-        res =jo.get("response", "")
-        msg["output"] = res
-        out += res
-    except:
-      msg["output"] = line 
-      out += line
-    
-    if sock is not None:
-        buf = json.dumps(msg).encode("utf-8") 
-        print(buf)
-        sock.sendall(buf)
-  if sock is not None:
-    sock.close()
-  return out
-
-def ask(args, model, inp):
-    msg = { "model": model, "prompt": inp, "stream": True }
-    return req.post(url(args, "generate"), json=msg, stream=True).iter_lines()
-
-def models(args, search=None):
+      while not limits.reason:
+        try:
+          line = queue.get_nowait()
+        except asyncio.QueueEmpty:
+          get = asyncio.create_task(queue.get())
+          await asyncio.wait([get, stopped], return_when=asyncio.FIRST_COMPLETED)
+          if not get.done():
+            get.cancel()
+            break
+          line = get.result()
+        if line is pipeline.DONE:
+          break
+        (msg, res) = parse(line)
+        if res:
+          limits.count()
+          if limits.reason:
+            break
+        out.append(res)
+        if writer is not None and msg:
+          try:
+            writer.write(msg)
+            await sink.drain()
+          except (ConnectionError, OSError):
+            limits.stop("client disconnected")
+      if limits.reason:
+        print(f"stopped: {limits.reason} after {limits.tokens} tokens")
+        note = f"\n[stopped: {limits.reason}]\n"
+        out.append(note)
+        if writer is not None and limits.reason != "client disconnected":
+          writer.write({"output": note})
+    finally:
+      watcher.cancel()
+      stopped.cancel()
+      if writer is not None:
+        try:
+          writer.close()
+        except (ConnectionError, OSError):
+          pass
+        await sink.wait_closed()
+    return "".join(out)
+
+  return await pipeline.run(lines, consume, opts)
+
+def stream(args, lines, state=None):
+  return asyncio.run(astream(args, lines, state))
+
+def relay(args, lines, state=None):
+  # an upstream failing or too slow is answered, as a missing OLLAMA_API_HOST
+  try:
+    return stream(args, lines, state)
+  except (TimeoutError, requests.RequestException) as e:
+    print("chat:", e)
+    return stream(args, [f"Error: {e}\n"], state)
+
+# generation options accepted in the args and passed to ollama
+OPTIONS = ["num_predict", "num_ctx", "temperature", "top_p", "top_k", "seed"]
+
+def options(args):
+  return { key: args[key] for key in OPTIONS if key in args }
+
+def ask(args, model, inp, options=None, context=None):
+    msg = { "model": model, "prompt": inp, "stream": True, "keep_alive": residency.keep_alive(args, model) }
+    if options:
+      msg["options"] = options
+    if context:
+      msg["context"] = context
+    return meter.Meter(args, model, balancer.Lines(args, "generate", model, json=msg))
+
+def semantic(args):
+  # semcache pulls pymilvus and vdb: imported only when the semantic cache is enabled
+  if str(args.get("CHAT_SEMANTIC_CACHE", "false")).lower() in ["1", "true", "yes"]:
+    import semcache
+    return semcache
+  return None
+
+def select(args, search):
+    names = catalog.load(args, urls(args, "tags"))
+    return residency.prefer(catalog.matches(names, search), residency.loaded(args, urls(args, "ps")))
+
+def models(args, selected=None):
     msg = {}
-    api = url(args, "tags")
-    data = req.get(api).json()
-    msg["response"] = "models available:\n"
-    yield json.dumps(msg).encode("utf-8")
-    for model in data.get("models", []):
-      time.sleep(0.1)
-      name = model.get("name", "")
-      if search and name.startswith(search):
-        msg["response"] = f"selected {name}\n"
-        msg["state"] = name
-        yield json.dumps(msg).encode("utf-8")
-        break
-      msg["response"] = name+"\n"
+    if selected:
+      msg["response"] = f"selected {selected}\n"
+      msg["state"] = selected
       yield json.dumps(msg).encode("utf-8")
+      return
+    names = catalog.load(args, urls(args, "tags"))
+    # warm models are marked with a *
+    warm = residency.loaded(args, urls(args, "ps"))
+    msg["response"] = "models available (* = loaded):\n" + "".join(f"{'*' if name in warm else ' '} {name}\n" for name in names)
+    yield json.dumps(msg).encode("utf-8")
 
 USAGE= """Welcome to Ollama.
 Type `@` to see available models.
 Type `@prefix` to select a model."
+Type `@auto` to let the router choose the model of each prompt.
+Type `!stats` to see connection reuse and backend statistics.
+Type `!refresh` to reload the list of models.
+Type `!new` to start a new conversation.
+Type `!stop` to stop the current answer.
+"""
+
+NOTIERS="""No CHAT_ROUTER_TIERS set.
+Please use `ops env add CHAT_ROUTER_TIERS=<small model>,<bigger model>[,...]`
+to set it and redeploy.
 """
 
 NOAPIHOST="""No OLLAMA_API_HOST set.
-Please use `ops env add OLLAMA_API_HOST=<url>`
+Please use `ops env add OLLAMA_API_HOST=<url>[,<url>...]`
 to set it and redeploy.
 """
 
@@ -80,23 +183,82 @@ def chat(args):
   if args.get("OLLAMA_API_HOST", os.getenv("OLLAMA_API_HOST", "")) == "":
     return {"output": NOAPIHOST}
 
-  model = args.get("state", "")
+  (model, session) = sessions.split(args.get("state", ""))
   title = args.get("title", "")
-  state = {"state": model }
+  state = {"state": sessions.join(model, session) }
   inp = args.get("input", "")
   out = USAGE
-  print(f"model={model} title={title}")
-  if inp == "@":
+  print(f"model={model} session={session} title={title}")
+  if inp == "!stats":
+    reports = [client.report(), balancer.report()]
+    cache = semantic(args)
+    if cache:
+      reports.append(cache.report(args))
+    out = stream(args, reports, state)
+  elif inp == "!stop":
+    if guard.abort(args, session):
+      out = stream(args, ["Stopping the current answer.\n"], state)
+    else:
+      out = stream(args, ["Nothing to stop.\n"], state)
+  elif inp == "!new":
+    state = {"state": router.AUTO if router.active(model) else model}
+    out = stream(args, ["New conversation.\n"], state)
+  elif inp == "!refresh":
+    catalog.invalidate()
+    out = stream(args, models(args), state)
+  elif inp == "@":
     lines = models(args)
     out = stream(args, lines, state)
+    residency.pin(args, urls(args, "ps"), lambda name: url(args, "generate", name))
+  elif inp == f"@{router.AUTO}":
+    state = {"state": router.AUTO}
+    tiers = router.tiers(args)
+    out = stream(args, [f"router mode, tiers: {' < '.join(tiers)}\n" if tiers else NOTIERS], state)
   elif inp.startswith("@"):
-    lines = models(args, inp[1:])
-    out = stream(args, lines, state)
+    # no match lists all the models
+    name = select(args, inp[1:])
+    out = stream(args, models(args, name), state)
+    # load the new model while the user writes the prompt
+    if name and name != model:
+      residency.preload(args, url(args, "generate", name), name)
+    residency.pin(args, urls(args, "ps"), lambda name: url(args, "generate", name))
   elif inp != "":
-    if model != "": 
-      lines = ask(args, model, inp)
+    opts = options(args)
+    if guard.max_tokens(args) and "num_predict" not in opts:
+      # let ollama stop at the budget too
+      opts["num_predict"] = guard.max_tokens(args)
+    target = model
+    if router.active(model):
+      if session and router.chosen(model):
+        (target, reason) = (router.chosen(model), "same conversation")
+      else:
+        (target, reason) = router.route(args, inp, opts)
+      print(f"router: {target} {reason}")
+    if target:
+      if not session:
+        session = sessions.new(args)
+      state = {"state": sessions.join(router.state(target) if router.active(model) else target, session)}
+      who = admission.user(args, session)
+      context = sessions.load(args, session)
+      # only the calls to ollama take a slot: cache hits and followers are not admitted
+      if context:
+        # the response depends on the conversation, so it is not cached
+        lines = admission.admitted(args, who, lambda: ask(args, target, inp, opts, context))
+      else:
+        upstream = lambda: admission.admitted(args, who, lambda: ask(args, target, inp, opts))
+        generate = lambda: singleflight.coalesce(args, target, inp, opts, upstream)
+        cache = semantic(args)
+        similar = (lambda: cache.cached(args, target, inp, opts, generate)) if cache else generate
+        lines = respcache.cached(args, target, inp, opts, similar)
+      lines = router.Running(args, target, lines)
+      lines = guard.Running(args, session, sessions.Recorder(args, session, lines))
+    elif router.active(model):
+      lines = [NOTIERS]
     else:
       lines =["No model selected.\n", "Please use @prefix to select a model."]
-    out = stream(args, lines, state)
+    out = relay(args, lines, state)
   
+  # the generation drained for the followers ends in this activation
+  singleflight.join(args)
+  print(f"pool: {client.report()}", end="")
   return { "output": out, "streaming": True }
@@ -0,0 +1,62 @@
+import os, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# keep-alive pool to the ollama host, shared by all the invocations of a warm container
+
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 300
+RETRIES = 2
+
+session = None
+timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+def env(args, key, default):
+  return args.get(key) or os.getenv(key) or default
+
+def connect(args):
+  global session, timeout
+  if not session:
+    size = int(env(args, "OLLAMA_POOL_SIZE", POOL_SIZE))
+    retries = int(env(args, "OLLAMA_RETRIES", RETRIES))
+    timeout = (
+      float(env(args, "OLLAMA_CONNECT_TIMEOUT", CONNECT_TIMEOUT)),
+      float(env(args, "OLLAMA_READ_TIMEOUT", READ_TIMEOUT))
+    )
+    # failed connects are always safe to retry (nothing was sent),
+    # read errors and bad statuses only for idempotent methods
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+      backoff_factor=0.2, status_forcelist=[502, 503, 504],
+      allowed_methods=["GET", "HEAD"], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+  return session
+
+def get(args, url, **kwargs):
+  return connect(args).get(url, timeout=timeout, **kwargs)
+
+def post(args, url, **kwargs):
+  return connect(args).post(url, timeout=timeout, **kwargs)
+
+def stats():
+  """
+  Return (requests, new connections, reused connections) for the pool.
+  """
+  nreq, nconn = 0, 0
+  if session:
+    for adapter in set(session.adapters.values()):
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+          nreq += pool.num_requests
+          nconn += pool.num_connections
+  return (nreq, nconn, nreq - nconn)
+
+def report():
+  (nreq, nconn, reused) = stats()
+  ratio = reused / nreq if nreq else 0.0
+  return f"requests: {nreq} connections: {nconn} reused: {reused} ({ratio:.0%})\n"
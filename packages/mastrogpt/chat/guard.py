@@ -0,0 +1,126 @@
+import time, asyncio
+import rdb
+
+# stop a generation early: when the streamer closes the connection (the client went away),
+# when `!stop` is sent for the same session (ABORT:<session> in redis),
+# or when the time limit or the token budget are exceeded.
+# the relay then stops and the upstream response is closed, so ollama stops generating.
+# `!stop` sets the abort only while a generation of the session runs (RUNNING:<session>),
+# and the abort is dropped when the generation ends: it is never left for the next prompt.
+
+POLL = 0.5
+ABORT_TTL = 60
+RUNNING_TTL = 600
+
+# KEYS: running, abort
+# ARGV: abort ttl
+ABORT = """
+if tonumber(redis.call('get', KEYS[1]) or '0') > 0 then
+  redis.call('setex', KEYS[2], ARGV[1], 1)
+  return 1
+end
+return 0
+"""
+
+def abort(args, session):
+  (rd, prefix) = rdb.connect(args)
+  if not rd or not session:
+    return False
+  return rd.eval(ABORT, 2, f"{prefix}RUNNING:{session}", f"{prefix}ABORT:{session}", ABORT_TTL) == 1
+
+def max_tokens(args):
+  return int(args.get("CHAT_MAX_TOKENS") or 0)
+
+class Guard:
+
+  def __init__(self, args, session=""):
+    self.args = args
+    self.session = session
+    self.max_time = float(args.get("CHAT_MAX_TIME") or 0)
+    self.max_tokens = max_tokens(args)
+    self.start = time.monotonic()
+    self.tokens = 0
+    self.reason = None
+    self.stopped = asyncio.Event()
+
+  def stop(self, reason):
+    if not self.reason:
+      self.reason = reason
+      self.stopped.set()
+
+  def count(self):
+    self.tokens += 1
+    if self.max_tokens and self.tokens > self.max_tokens:
+      self.stop("token budget")
+
+  def aborted(self):
+    (rd, prefix) = rdb.connect(self.args)
+    if not rd or not self.session:
+      return False
+    return rd.delete(f"{prefix}ABORT:{self.session}") > 0
+
+  async def watch(self, reader=None, closed=None):
+    # closed: a threading.Event set when the client of a shared connection went away
+    async def eof():
+      # the streamer does not send anything: a read returns only at close
+      while await reader.read(4096):
+        pass
+      self.stop("client disconnected")
+    task = asyncio.create_task(eof()) if reader is not None else None
+    try:
+      while not self.reason:
+        await asyncio.sleep(POLL)
+        if closed is not None and closed.is_set():
+          self.stop("client disconnected")
+        elif self.max_time and time.monotonic() - self.start > self.max_time:
+          self.stop("time limit")
+        elif await asyncio.to_thread(self.aborted):
+          self.stop("aborted")
+    finally:
+      if task is not None:
+        task.cancel()
+
+class Running:
+  """
+  Mark a generation of the session as running while its lines are read.
+  """
+  def __init__(self, args, session, lines):
+    self.args = args
+    self.session = session
+    self.lines = lines
+    self.counted = False
+
+  def __iter__(self):
+    (rd, prefix) = rdb.connect(self.args)
+    name = f"{prefix}RUNNING:{self.session}"
+    try:
+      if rd and self.session:
+        try:
+          pipe = rd.pipeline()
+          pipe.incr(name)
+          pipe.expire(name, RUNNING_TTL)
+          pipe.execute()
+          self.counted = True
+        except Exception as e:
+          print("guard:", e)
+      yield from self.lines
+    finally:
+      self.done()
+
+  def done(self):
+    if self.counted:
+      self.counted = False
+      (rd, prefix) = rdb.connect(self.args)
+      try:
+        if rd.decr(f"{prefix}RUNNING:{self.session}") <= 0:
+          # an abort not seen by the relay is not left for the next prompt
+          rd.delete(f"{prefix}ABORT:{self.session}")
+      except Exception as e:
+        print("guard:", e)
+
+  def close(self):
+    try:
+      if hasattr(self.lines, "close"):
+        self.lines.close()
+    finally:
+      self.done()
@@ -0,0 +1,99 @@
+import json, time, bisect
+import rdb
+
+# latency and throughput of each generation, aggregated per model in redis histograms:
+# METRICS:<model>:<metric> is a hash with the count of each bucket (le:<upper bound>),
+# plus the total count and sum; METRICS:models is the set of the models measured.
+# the metrics action reads them back.
+
+BUCKETS = {
+  "ttft_ms": [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000],
+  "itl_ms": [5, 10, 20, 35, 50, 75, 100, 150, 250, 500, 1000],
+  "tps": [5, 10, 20, 30, 50, 75, 100, 150, 250, 500],
+  "prefill_ms": [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000],
+  "load_ms": [10, 100, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+}
+
+def bucket(metric, value):
+  bounds = BUCKETS[metric]
+  i = bisect.bisect_left(bounds, value)
+  return f"le:{bounds[i]}" if i < len(bounds) else "le:inf"
+
+class Histograms:
+  """
+  Bucket counts of a single generation, written to redis at the end.
+  """
+  def __init__(self):
+    self.data = {}
+
+  def add(self, metric, value):
+    hist = self.data.setdefault(metric, {"count": 0, "sum": 0.0})
+    key = bucket(metric, value)
+    hist[key] = hist.get(key, 0) + 1
+    hist["count"] += 1
+    hist["sum"] += value
+
+  def save(self, args, model):
+    (rd, prefix) = rdb.connect(args)
+    if not rd or not self.data:
+      return
+    pipe = rd.pipeline()
+    pipe.sadd(f"{prefix}METRICS:models", model)
+    for (metric, hist) in self.data.items():
+      name = f"{prefix}METRICS:{model}:{metric}"
+      for (field, value) in hist.items():
+        if field == "sum":
+          pipe.hincrbyfloat(name, field, value)
+        else:
+          pipe.hincrby(name, field, value)
+    pipe.execute()
+
+class Meter:
+  """
+  Pass through the lines of a generation, measuring ttft and inter token latency,
+  and reading throughput, prefill and load time from the last chunk.
+  """
+  def __init__(self, args, model, lines):
+    self.args = args
+    self.model = model
+    self.lines = lines
+
+  def __iter__(self):
+    hist = Histograms()
+    start = time.perf_counter()
+    last = None
+    for line in self.lines:
+      now = time.perf_counter()
+      if last is None:
+        hist.add("ttft_ms", (now - start) * 1000)
+      else:
+        hist.add("itl_ms", (now - last) * 1000)
+      last = now
+      yield line
+      # only the last chunk has the stats
+      if b'"eval_count"' in line:
+        self.final(hist, line)
+    try:
+      hist.save(self.args, self.model)
+    except Exception as e:
+      print("meter:", e)
+
+  def final(self, hist, line):
+    try:
+      jo = json.loads(line)
+    except Exception:
+      return
+    count = jo.get("eval_count", 0)
+    duration = jo.get("eval_duration", 0)
+    if count and duration:
+      hist.add("tps", count / (duration / 1e9))
+    hist.add("prefill_ms", jo.get("prompt_eval_duration", 0) / 1e6)
+    hist.add("load_ms", jo.get("load_duration", 0) / 1e6)
+    ttft = hist.data.get("ttft_ms", {}).get("sum", 0)
+    print(f"meter: {self.model} ttft={ttft:.0f}ms tokens={count} "
+          f"tps={count / (duration / 1e9) if duration else 0:.1f} "
+          f"prefill={jo.get('prompt_eval_duration', 0) / 1e6:.0f}ms load={jo.get('load_duration', 0) / 1e6:.0f}ms")
+
+  def close(self):
+    if hasattr(self.lines, "close"):
+      self.lines.close()
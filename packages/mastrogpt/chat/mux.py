@@ -0,0 +1,120 @@
+import json, socket, secrets, threading
+
+# persistent connection to the streamer, shared by the invocations of a warm container
+# and by concurrent chats: every frame carries the id of its channel.
+# action -> streamer: {"channel": id, "state": ...} opens the channel, then the outputs,
+# then {"channel": id, "done": true} closes it.
+# streamer -> action: {"channel": id, "ack": true} once the state is processed,
+# and {"channel": id, "close": true} when the client of the channel went away.
+# enabled with STREAM_MUX=true, for streamers speaking this protocol.
+
+connections = {}
+lock = threading.Lock()
+
+def enabled(args):
+  return str(args.get("STREAM_MUX", "")).lower() in ["1", "true", "yes"]
+
+class Connection:
+  """
+  A socket to the streamer, with a thread reading the acks and closes of the channels.
+  """
+  def __init__(self, addr, timeout):
+    self.sock = socket.create_connection(addr, timeout)
+    self.sock.settimeout(None)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.channels = {}
+    self.lock = threading.Lock()
+    self.alive = True
+    threading.Thread(target=self.read, daemon=True).start()
+
+  def read(self):
+    try:
+      with self.sock.makefile("rb") as lines:
+        for line in lines:
+          try:
+            msg = json.loads(line)
+          except ValueError:
+            continue
+          channel = self.channels.get(msg.get("channel"))
+          if channel is None:
+            continue
+          if msg.get("ack"):
+            channel.acked.set()
+          if msg.get("close"):
+            channel.closed.set()
+    except OSError:
+      pass
+    self.drop()
+
+  def drop(self):
+    self.alive = False
+    with lock:
+      for (addr, conn) in list(connections.items()):
+        if conn is self:
+          del connections[addr]
+    for channel in list(self.channels.values()):
+      channel.closed.set()
+    try:
+      self.sock.close()
+    except OSError:
+      pass
+
+  def sendall(self, buf):
+    with self.lock:
+      try:
+        self.sock.sendall(buf)
+      except OSError:
+        self.drop()
+        raise
+
+def connect(addr, timeout):
+  with lock:
+    conn = connections.get(addr)
+  if conn is None or not conn.alive:
+    conn = Connection(addr, timeout)
+    with lock:
+      connections[addr] = conn
+  return conn
+
+class Channel:
+  """
+  A chat on the shared connection, with the sendall/close/drain/wait_closed of pipeline.Sink.
+  """
+  def __init__(self, addr, timeout):
+    self.addr = addr
+    self.timeout = timeout
+    self.id = secrets.token_hex(8)
+    self.acked = threading.Event()
+    self.closed = threading.Event()
+    self.sent = False
+    self.conn = connect(addr, timeout)
+    self.conn.channels[self.id] = self
+
+  def sendall(self, buf):
+    if self.closed.is_set():
+      raise ConnectionError("channel closed")
+    try:
+      self.conn.sendall(buf)
+    except OSError:
+      if self.sent:
+        raise
+      # the pooled connection broke while idle: nothing was sent yet, so use a new one
+      self.conn.channels.pop(self.id, None)
+      self.closed.clear()
+      self.conn = connect(self.addr, self.timeout)
+      self.conn.channels[self.id] = self
+      self.conn.sendall(buf)
+    self.sent = True
+
+  def close(self):
+    try:
+      if not self.closed.is_set():
+        self.conn.sendall(json.dumps({"channel": self.id, "done": True}).encode("utf-8") + b"\n")
+    finally:
+      self.conn.channels.pop(self.id, None)
+
+  async def drain(self):
+    pass
+
+  async def wait_closed(self):
+    pass
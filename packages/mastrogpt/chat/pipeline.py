@@ -0,0 +1,241 @@
+import time, asyncio, threading, collections
+
+# asyncio relay: a producer reads the (blocking) upstream lines in a reader thread
+# and puts them in a bounded queue, a consumer takes them and writes downstream.
+# When the consumer is slow the queue fills and the producer stops reading,
+# so the backpressure reaches ollama through the tcp window.
+# The reader is a daemon thread, not a worker of the loop executor:
+# asyncio.run() waits for the executor, so a read blocked on ollama would delay
+# the end of the action past a timeout or a stop.
+
+QUEUE_SIZE = 64
+CONNECT_TIMEOUT = 5.0
+FIRST_TIMEOUT = 120.0
+TOKEN_TIMEOUT = 30.0
+SEND_TIMEOUT = 10.0
+ACK_TIMEOUT = 1.0
+
+DONE = object()
+
+def options(args):
+  def opt(key, default):
+    return float(args.get(key) or default)
+  return {
+    "queue_size": int(opt("STREAM_QUEUE_SIZE", QUEUE_SIZE)),
+    "connect": opt("STREAM_CONNECT_TIMEOUT", CONNECT_TIMEOUT),
+    "first": opt("OLLAMA_FIRST_TOKEN_TIMEOUT", FIRST_TIMEOUT),
+    "token": opt("OLLAMA_TOKEN_TIMEOUT", TOKEN_TIMEOUT),
+    "send": opt("STREAM_SEND_TIMEOUT", SEND_TIMEOUT),
+    "ack": opt("STREAM_ACK_TIMEOUT", ACK_TIMEOUT)
+  }
+
+class Sink:
+  """
+  Adapt an asyncio StreamWriter to the sendall/close used by the FrameWriter.
+  Writes are buffered by the transport, drain() waits for the buffer to empty.
+  """
+  def __init__(self, writer, timeout=SEND_TIMEOUT):
+    self.writer = writer
+    self.timeout = timeout
+
+  def sendall(self, buf):
+    self.writer.write(buf)
+
+  def close(self):
+    self.writer.close()
+
+  async def drain(self):
+    await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+  async def wait_closed(self):
+    try:
+      await asyncio.wait_for(self.writer.wait_closed(), self.timeout)
+    except Exception:
+      pass
+
+class Queue:
+  """
+  A bounded queue from a thread to the loop: the thread takes a slot before each line
+  and blocks while there are none, the slot is given back when the line is taken.
+  Lines go through a deque without locks: the loop is woken only when the consumer waits,
+  and the thread only when half of the slots are free (the consumer drains the queue before waiting).
+  """
+  def __init__(self, loop, maxsize):
+    self.loop = loop
+    self.items = collections.deque()
+    self.maxsize = maxsize
+    self.low = maxsize // 2
+    # sent is written only by the thread, taken only by the loop
+    self.sent = 0
+    self.taken = 0
+    self.stopped = False
+    self.space = threading.Condition()
+    self.waiter = None
+
+  def take(self):
+    # called by the reader thread, blocks while the queue is full
+    if self.sent - self.taken >= self.maxsize:
+      with self.space:
+        while self.sent - self.taken >= self.maxsize and not self.stopped:
+          self.space.wait()
+    self.sent += 1
+
+  def stop(self):
+    with self.space:
+      self.stopped = True
+      self.space.notify()
+
+  def put(self, item):
+    # called by the reader thread
+    self.items.append(item)
+    waiter = self.waiter
+    if waiter is not None:
+      self.waiter = None
+      self.loop.call_soon_threadsafe(wake, waiter)
+
+  def empty(self):
+    return not self.items
+
+  def get_nowait(self):
+    try:
+      item = self.items.popleft()
+    except IndexError:
+      raise asyncio.QueueEmpty()
+    self.taken += 1
+    if self.sent - self.taken == self.low:
+      with self.space:
+        self.space.notify()
+    return item
+
+  async def get(self):
+    while not self.items:
+      waiter = self.waiter = self.loop.create_future()
+      # a line put before the waiter was set did not wake it
+      if self.items:
+        self.waiter = None
+        break
+      await waiter
+    return self.get_nowait()
+
+def wake(waiter):
+  if not waiter.done():
+    waiter.set_result(None)
+
+class Reader:
+  """
+  Read the upstream lines in a daemon thread and hand them to the loop.
+  """
+  def __init__(self, lines, queue, loop):
+    self.lines = lines
+    self.queue = queue
+    self.loop = loop
+    self.count = 0
+    self.last = time.monotonic()
+    self.reading = False
+    self.stopped = False
+    self.done = loop.create_future()
+    threading.Thread(target=self.run, daemon=True).start()
+
+  def post(self, callback, *args):
+    try:
+      self.loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+      # the loop is closed: the relay is over
+      pass
+
+  def finish(self, error):
+    if not self.done.done():
+      if error is None:
+        self.done.set_result(None)
+      else:
+        self.done.set_exception(error)
+
+  def run(self):
+    it = iter(self.lines)
+    error = None
+    try:
+      while True:
+        self.queue.take()
+        if self.stopped:
+          break
+        self.last = time.monotonic()
+        self.reading = True
+        line = next(it, DONE)
+        self.reading = False
+        if self.stopped:
+          break
+        try:
+          self.queue.put(line)
+        except RuntimeError:
+          # the loop is closed: the relay is over
+          break
+        if line is DONE:
+          break
+        self.count += 1
+    except Exception as e:
+      # after a stop, the error is the upstream being closed
+      error = None if self.stopped else e
+    finally:
+      self.reading = False
+      if hasattr(it, "close"):
+        try:
+          it.close()
+        except Exception:
+          pass
+    self.post(self.finish, error)
+
+  def stop(self):
+    if self.done.done():
+      return
+    self.stopped = True
+    # wake the thread if it waits for a slot, or if it is reading the upstream
+    self.queue.stop()
+    close(self.lines)
+
+async def produce(lines, queue, first=FIRST_TIMEOUT, token=TOKEN_TIMEOUT):
+  reader = Reader(lines, queue, asyncio.get_running_loop())
+  try:
+    while not reader.done.done():
+      timeout = token if reader.count else first
+      # while the reader waits for a slot, the upstream is not late
+      left = reader.last + timeout - time.monotonic() if reader.reading else timeout
+      if left <= 0:
+        raise TimeoutError(f"no line from the upstream in {timeout}s")
+      await asyncio.wait([reader.done], timeout=left)
+    reader.done.result()
+  finally:
+    reader.stop()
+
+def close(lines):
+  # unblock the reader thread still reading the upstream
+  try:
+    if hasattr(lines, "close"):
+      lines.close()
+  except Exception:
+    pass
+
+def failed(task):
+  return task.done() and not task.cancelled() and task.exception() is not None
+
+async def run(lines, consume, opts):
+  """
+  Relay lines to consume(queue), return what the consumer returns.
+  An error (or timeout) in either stage cancels the other one and closes the upstream,
+  as does a consumer returning before the end of the lines.
+  """
+  queue = Queue(asyncio.get_running_loop(), opts["queue_size"])
+  producer = asyncio.create_task(produce(lines, queue, opts["first"], opts["token"]))
+  consumer = asyncio.create_task(consume(queue))
+  try:
+    await asyncio.wait([producer, consumer], return_when=asyncio.FIRST_COMPLETED)
+    if producer.done() and not failed(producer):
+      await asyncio.wait([consumer])
+  finally:
+    # a producer cancelled or failed stops its reader, and the reader closes the upstream
+    for task in [producer, consumer]:
+      if not task.done():
+        task.cancel()
+  await asyncio.gather(producer, consumer, return_exceptions=True)
+  if failed(producer):
+    raise producer.exception()
+  return consumer.result()
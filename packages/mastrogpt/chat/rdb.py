@@ -0,0 +1,17 @@
+import os, redis
+
+# redis connection shared by the invocations of a warm container
+# None when REDIS_URL is not set, so the features using it are just disabled
+
+rd = None
+prefix = ""
+
+def connect(args):
+  global rd, prefix
+  if not rd:
+    url = args.get("REDIS_URL") or os.getenv("REDIS_URL")
+    if not url:
+      return (None, prefix)
+    rd = redis.from_url(url)
+    prefix = args.get("REDIS_PREFIX") or os.getenv("REDIS_PREFIX") or ""
+  return (rd, prefix)
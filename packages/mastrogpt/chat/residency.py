@@ -0,0 +1,71 @@
+import time
+import client
+
+# which models are loaded in ollama (from /api/ps), and how long they stay there.
+# the selected model is preloaded, the HOT models are pinned with keep_alive -1,
+# the others are kept for KEEP_ALIVE after the last request.
+
+KEEP_ALIVE = "10m"
+PS_TTL = 5
+PRELOAD_TIMEOUT = 120
+
+resident = set()
+expires = 0.0
+
+def hot(args):
+  models = client.env(args, "OLLAMA_HOT_MODELS", "")
+  return [m.strip() for m in models.split(",") if m.strip()]
+
+def keep_alive(args, model):
+  if model in hot(args):
+    return -1
+  return client.env(args, "OLLAMA_KEEP_ALIVE", KEEP_ALIVE)
+
+def invalidate():
+  global expires
+  expires = 0.0
+
+def loaded(args, apis):
+  """
+  Return the names of the models currently loaded in any backend, cached for PS_TTL seconds.
+  """
+  global resident, expires
+  now = time.time()
+  if now >= expires:
+    found = set()
+    for api in apis:
+      try:
+        data = client.get(args, api).json()
+        found.update(model.get("name", "") for model in data.get("models", []))
+      except Exception as e:
+        print("residency:", e)
+    resident = found
+    expires = now + PS_TTL
+  return resident
+
+def prefer(names, resident):
+  """
+  Choose among the matching names, favouring the ones already loaded.
+  """
+  for name in names:
+    if name in resident:
+      return name
+  return names[0] if names else None
+
+def preload(args, api, model):
+  # a generate without prompt just loads the model
+  msg = {"model": model, "keep_alive": keep_alive(args, model)}
+  try:
+    start = time.time()
+    client.connect(args).post(api, json=msg, timeout=(client.timeout[0], PRELOAD_TIMEOUT)).close()
+    print(f"preloaded {model} in {time.time() - start:.2f}s")
+    resident.add(model)
+  except Exception as e:
+    print("residency:", e)
+
+def pin(args, ps, generate):
+  # load the hot models not yet resident, generate(model) is the url of its backend
+  current = loaded(args, ps)
+  for model in hot(args):
+    if model not in current:
+      preload(args, generate(model), model)
@@ -0,0 +1,105 @@
+import json, hashlib, time
+import rdb, sessions
+
+# exact match cache of the responses, keyed on a hash of model, prompt and options.
+# the context of the response is stored too, to continue the session after a hit.
+# the keys are listed in a sorted set by insertion time to keep at most MAX_ENTRIES
+
+TTL = 3600
+MAX_ENTRIES = 10000
+MAX_SIZE = 65536
+
+def key(model, prompt, options=None):
+  data = json.dumps([model, prompt, options or {}], sort_keys=True)
+  return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def options(args):
+  return {
+    "ttl": int(args.get("CHAT_CACHE_TTL") or TTL),
+    "max_entries": int(args.get("CHAT_CACHE_MAX_ENTRIES") or MAX_ENTRIES),
+    "max_size": int(args.get("CHAT_CACHE_MAX_SIZE") or MAX_SIZE)
+  }
+
+def get(args, model, prompt, opts=None):
+  (rd, prefix) = rdb.connect(args)
+  if not rd:
+    return None
+  name = f"{prefix}CHAT:{key(model, prompt, opts)}"
+  (res, ctx) = rd.mget(name, f"{name}:ctx")
+  if res is None:
+    return None
+  return (res.decode("utf-8"), sessions.unpack(ctx) if ctx else None)
+
+def put(args, model, prompt, opts, text, context=None):
+  (rd, prefix) = rdb.connect(args)
+  cfg = options(args)
+  data = text.encode("utf-8")
+  if not rd or len(data) > cfg["max_size"]:
+    return
+  name = f"{prefix}CHAT:{key(model, prompt, opts)}"
+  index = f"{prefix}CHAT:index"
+  pipe = rd.pipeline()
+  pipe.setex(name, cfg["ttl"], data)
+  if context:
+    pipe.setex(f"{name}:ctx", cfg["ttl"], sessions.pack(context))
+  pipe.zadd(index, {name: time.time()})
+  # forget the entries already expired, then the oldest beyond the limit
+  pipe.zremrangebyscore(index, 0, time.time() - cfg["ttl"])
+  pipe.zrange(index, 0, -cfg["max_entries"] - 1)
+  old = pipe.execute()[-1]
+  if old:
+    pipe = rd.pipeline()
+    pipe.delete(*old, *[name + b":ctx" for name in old])
+    pipe.zrem(index, *old)
+    pipe.execute()
+
+def replay(text, context=None):
+  msg = {"response": text, "done": True}
+  if context:
+    msg["context"] = context
+  yield json.dumps(msg).encode("utf-8")
+
+class Recorder:
+  """
+  Pass through the lines of a generation, and store the response
+  when the generation completed.
+  """
+  def __init__(self, args, model, prompt, opts, lines):
+    self.args = args
+    self.model = model
+    self.prompt = prompt
+    self.opts = opts
+    self.lines = lines
+
+  def __iter__(self):
+    out = []
+    for line in self.lines:
+      yield line
+      try:
+        jo = json.loads(line)
+      except:
+        continue
+      out.append(jo.get("response", ""))
+      if jo.get("done"):
+        try:
+          put(self.args, self.model, self.prompt, self.opts, "".join(out), jo.get("context"))
+        except Exception as e:
+          print("cache:", e)
+
+  def close(self):
+    if hasattr(self.lines, "close"):
+      self.lines.close()
+
+def cached(args, model, prompt, opts, generate):
+  """
+  Return the lines of the cached response, or record the lines from generate().
+  """
+  try:
+    res = get(args, model, prompt, opts)
+  except Exception as e:
+    print("cache:", e)
+    return generate()
+  if res is not None:
+    print(f"cache hit {model}")
+    return replay(*res)
+  return Recorder(args, model, prompt, opts, generate())
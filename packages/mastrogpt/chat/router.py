@@ -0,0 +1,131 @@
+import os
+import rdb, guard
+
+# router mode (`@auto`): the model of each prompt is chosen from CHAT_ROUTER_TIERS,
+# a comma separated list of models from the smallest to the most capable.
+# the size of a request is the prompt length (about 4 characters per token) plus the output budget;
+# CHAT_ROUTER_LIMITS are the sizes above which the next tier is needed.
+# among the tiers big enough, the one with the lowest estimated latency wins:
+# time to first token + budget / tokens per second, measured by meter.py,
+# plus the same for each generation already running on the model (ROUTER:inflight:<model>).
+# the chosen model is carried in the state as auto=<model>, and a conversation with a context
+# stays on its model: the context is made of token ids of that model, and its kv cache is warm.
+
+AUTO = "auto"
+LIMITS = [512, 4096]
+# output budget when num_predict is not given: twice the prompt, within these bounds
+MIN_BUDGET = 128
+MAX_BUDGET = 1024
+# until measured, smaller tiers are assumed faster
+TPS = 100.0
+TTFT_MS = 500.0
+INFLIGHT_TTL = 600
+
+def active(model):
+  return model == AUTO or model.startswith(f"{AUTO}=")
+
+def chosen(model):
+  return model[len(AUTO) + 1:] if model.startswith(f"{AUTO}=") else ""
+
+def state(model):
+  return f"{AUTO}={model}"
+
+def tiers(args):
+  value = args.get("CHAT_ROUTER_TIERS") or os.getenv("CHAT_ROUTER_TIERS") or ""
+  return [tier.strip() for tier in value.split(",") if tier.strip()]
+
+def limits(args):
+  value = args.get("CHAT_ROUTER_LIMITS") or ""
+  return [int(limit) for limit in value.split(",") if limit.strip()] or LIMITS
+
+def budget(args, prompt_tokens, opts):
+  if opts.get("num_predict"):
+    return int(opts["num_predict"])
+  if guard.max_tokens(args):
+    return guard.max_tokens(args)
+  return min(MAX_BUDGET, max(MIN_BUDGET, 2 * prompt_tokens))
+
+def measured(rd, prefix, model, metric):
+  (count, total) = rd.hmget(f"{prefix}METRICS:{model}:{metric}", "count", "sum")
+  return float(total) / int(count) if count and int(count) else None
+
+def estimate(rd, prefix, model, index, tokens):
+  """
+  Return (latency in ms, tps, running generations) of a generation of tokens on the model.
+  """
+  tps = TPS / (1 + index)
+  ttft = TTFT_MS
+  inflight = 0
+  if rd:
+    tps = measured(rd, prefix, model, "tps") or tps
+    ttft = measured(rd, prefix, model, "ttft_ms") or ttft
+    inflight = max(0, int(rd.get(f"{prefix}ROUTER:inflight:{model}") or 0))
+  one = ttft + tokens / tps * 1000
+  return (one * (1 + inflight), tps, inflight)
+
+def route(args, prompt, opts):
+  """
+  Return (model, reason) for the prompt, (None, reason) if there are no tiers.
+  """
+  names = tiers(args)
+  if not names:
+    return (None, "no CHAT_ROUTER_TIERS")
+  prompt_tokens = len(prompt) // 4 + 1
+  tokens = budget(args, prompt_tokens, opts)
+  size = prompt_tokens + tokens
+  first = min(sum(1 for limit in limits(args) if size > limit), len(names) - 1)
+  (rd, prefix) = rdb.connect(args)
+  best = None
+  for index in range(first, len(names)):
+    try:
+      (latency, tps, inflight) = estimate(rd, prefix, names[index], index, tokens)
+    except Exception as e:
+      print("router:", e)
+      (latency, tps, inflight) = estimate(None, prefix, names[index], index, tokens)
+    if best is None or latency < best[0]:
+      best = (latency, names[index], tps, inflight)
+  (latency, model, tps, inflight) = best
+  return (model, f"size={size} tier>={first} tps={tps:.0f} inflight={inflight} latency~{latency:.0f}ms")
+
+class Running:
+  """
+  Count the generation as running on the model while its lines are read.
+  """
+  def __init__(self, args, model, lines):
+    self.args = args
+    self.model = model
+    self.lines = lines
+    self.counted = False
+
+  def __iter__(self):
+    (rd, prefix) = rdb.connect(self.args)
+    name = f"{prefix}ROUTER:inflight:{self.model}"
+    try:
+      if rd:
+        try:
+          pipe = rd.pipeline()
+          pipe.incr(name)
+          pipe.expire(name, INFLIGHT_TTL)
+          pipe.execute()
+          self.counted = True
+        except Exception as e:
+          print("router:", e)
+      yield from self.lines
+    finally:
+      self.done()
+
+  def done(self):
+    if self.counted:
+      self.counted = False
+      (rd, prefix) = rdb.connect(self.args)
+      try:
+        rd.decr(f"{prefix}ROUTER:inflight:{self.model}")
+      except Exception as e:
+        print("router:", e)
+
+  def close(self):
+    try:
+      if hasattr(self.lines, "close"):
+        self.lines.close()
+    finally:
+      self.done()
@@ -0,0 +1,205 @@
+import os, json, time, random, hashlib
+import balancer, rdb, respcache, vdb, embeddings
+from pymilvus import DataType
+
+# semantic cache: the prompt is embedded and the nearest previous prompt of the same model
+# is searched in a milvus collection; when the similarity is above CHAT_SEMANTIC_THRESHOLD
+# the stored answer is returned without calling ollama.
+# the model is the partition key, so each model is a separate namespace,
+# only answers generated with the same options (a hash of them) are reused,
+# and entries expire after CHAT_SEMANTIC_TTL seconds.
+# hits, misses and the time spent in lookups and generations are counted in redis (SEMCACHE:stats):
+# when the expected saving of a lookup is lower than its cost, only a sample of the prompts is looked up.
+
+MODEL = "nomic-embed-text"
+COLLECTION = "semantic_cache"
+THRESHOLD = 0.92
+TTL = 86400
+MAX_ANSWER = 65535
+# lookups to measure before skipping them, and the fraction still done when skipped
+MIN_LOOKUPS = 50
+SAMPLE = 0.1
+PURGE_INTERVAL = 60
+
+db = None
+purged = 0.0
+
+def enabled(args):
+  return str(args.get("CHAT_SEMANTIC_CACHE", "false")).lower() in ["1", "true", "yes"] \
+    and bool(args.get("MILVUS_HOST") or os.getenv("MILVUS_HOST"))
+
+def options(args):
+  return {
+    "model": args.get("CHAT_SEMANTIC_MODEL") or MODEL,
+    "collection": args.get("CHAT_SEMANTIC_COLLECTION") or COLLECTION,
+    "threshold": float(args.get("CHAT_SEMANTIC_THRESHOLD") or THRESHOLD),
+    "ttl": int(args.get("CHAT_SEMANTIC_TTL") or TTL)
+  }
+
+def embed(args, model, text):
+  (bufs, _) = embeddings.vectors(args, model, [text], balancer.choose(args))
+  return embeddings.unpack(bufs[0]).tolist()
+
+def options_hash(opts):
+  return hashlib.sha256(json.dumps(opts or {}, sort_keys=True).encode("utf-8")).hexdigest()
+
+def entry_id(model, prompt, opts):
+  # from the exact cache key
+  return embeddings.text_id(respcache.key(model, prompt, opts))
+
+class SemanticCache(vdb.VectorDB):
+  """
+  A collection of prompts, with their embeddings and answers.
+  """
+  def __init__(self, args, collection, dimension):
+    self.dimension = dimension
+    super().__init__(args, collection)
+
+  def create(self, collection):
+    schema = self.client.create_schema()
+    schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
+    schema.add_field(field_name="model", datatype=DataType.VARCHAR, max_length=256, is_partition_key=True)
+    schema.add_field(field_name="options", datatype=DataType.VARCHAR, max_length=64)
+    schema.add_field(field_name="prompt", datatype=DataType.VARCHAR, max_length=vdb.DIMENSION_TEXT)
+    schema.add_field(field_name="answer", datatype=DataType.VARCHAR, max_length=MAX_ANSWER)
+    schema.add_field(field_name="expires", datatype=DataType.INT64)
+    schema.add_field(field_name="vector", datatype=DataType.FLOAT_VECTOR, dim=self.dimension)
+    index_params = self.client.prepare_index_params()
+    index_params.add_index(field_name="vector", index_type="AUTOINDEX", metric_type="COSINE")
+    self.client.create_collection(collection_name=collection, schema=schema, index_params=index_params)
+    print("collection_name=", collection)
+
+  def lookup(self, model, options, vector):
+    """
+    Return (similarity, answer) of the nearest prompt of the model with the same options not expired.
+    """
+    hits = self.client.search(collection_name=self.collection, data=[vector], anns_field="vector", limit=1,
+      filter=f"model == {json.dumps(model)} and options == {json.dumps(options)} and expires > {int(time.time())}",
+      search_params={"metric_type": "COSINE"}, output_fields=["answer"])
+    for hit in hits:
+      for rec in hit:
+        return (rec.get("distance", 0.0), rec.get("entity", {}).get("answer", ""))
+    return (0.0, None)
+
+  def store(self, id, model, options, prompt, answer, vector, ttl):
+    self.client.upsert(self.collection, {"id": id, "model": model, "options": options, "prompt": prompt,
+      "answer": answer, "expires": int(time.time()) + ttl, "vector": vector})
+
+  def purge(self):
+    self.client.delete(collection_name=self.collection, filter=f"expires <= {int(time.time())}")
+
+def connect(args, collection, dimension):
+  global db
+  if db is None or db.collection != collection:
+    db = SemanticCache(args, collection, dimension)
+  return db
+
+def count(args, **fields):
+  (rd, prefix) = rdb.connect(args)
+  if not rd:
+    return
+  try:
+    pipe = rd.pipeline()
+    for (field, value) in fields.items():
+      pipe.hincrbyfloat(f"{prefix}SEMCACHE:stats", field, value)
+    pipe.execute()
+  except Exception as e:
+    print("semcache:", e)
+
+def stats(args):
+  (rd, prefix) = rdb.connect(args)
+  if not rd:
+    return {}
+  try:
+    return {k.decode("utf-8"): float(v) for (k, v) in rd.hgetall(f"{prefix}SEMCACHE:stats").items()}
+  except Exception as e:
+    print("semcache:", e)
+    return {}
+
+def worth(data):
+  """
+  Look up when the saving expected from a hit is higher than the cost of the lookup.
+  """
+  lookups = data.get("lookups", 0)
+  if lookups < MIN_LOOKUPS or not data.get("generations"):
+    return True
+  saving = data.get("hits", 0) / lookups * data["generate_ms"] / data["generations"]
+  cost = data.get("lookup_ms", 0) / lookups
+  return saving >= cost or random.random() < SAMPLE
+
+def report(args):
+  data = stats(args)
+  lookups = data.get("lookups", 0)
+  if not lookups:
+    return "semantic cache: no lookups\n"
+  gen = data["generate_ms"] / data["generations"] if data.get("generations") else 0.0
+  return (f"semantic cache: lookups: {lookups:.0f} hits: {data.get('hits', 0):.0f} misses: {data.get('misses', 0):.0f} "
+          f"({data.get('hits', 0) / lookups:.0%}) skipped: {data.get('skipped', 0):.0f} "
+          f"lookup: {data.get('lookup_ms', 0) / lookups:.0f}ms generation: {gen:.0f}ms\n")
+
+class Recorder:
+  """
+  Pass through the lines of a generation, and store the answer with the prompt embedding
+  when the generation completed.
+  """
+  def __init__(self, args, store, lines):
+    self.args = args
+    self.store = store
+    self.lines = lines
+
+  def __iter__(self):
+    global purged
+    start = time.perf_counter()
+    out = []
+    for line in self.lines:
+      yield line
+      try:
+        jo = json.loads(line)
+      except:
+        continue
+      out.append(jo.get("response", ""))
+      if jo.get("done"):
+        count(self.args, generations=1, generate_ms=(time.perf_counter() - start) * 1000)
+        answer = "".join(out)
+        if len(answer.encode("utf-8")) > MAX_ANSWER:
+          continue
+        try:
+          self.store(answer)
+          if time.time() - purged > PURGE_INTERVAL:
+            purged = time.time()
+            db.purge()
+        except Exception as e:
+          print("semcache:", e)
+
+  def close(self):
+    if hasattr(self.lines, "close"):
+      self.lines.close()
+
+def cached(args, model, prompt, opts, generate):
+  """
+  Return the answer of a similar prompt, or record the lines from generate().
+  """
+  if not enabled(args):
+    return generate()
+  if not worth(stats(args)):
+    count(args, skipped=1)
+    return generate()
+  cfg = options(args)
+  start = time.perf_counter()
+  try:
+    vector = embed(args, cfg["model"], prompt)
+    cache = connect(args, cfg["collection"], len(vector))
+    (score, answer) = cache.lookup(model, options_hash(opts), vector)
+  except Exception as e:
+    print("semcache:", e)
+    return generate()
+  elapsed = (time.perf_counter() - start) * 1000
+  if answer is not None and score >= cfg["threshold"]:
+    count(args, lookups=1, hits=1, lookup_ms=elapsed)
+    print(f"semantic cache hit {model} score={score:.3f} in {elapsed:.0f}ms")
+    return respcache.replay(answer)
+  count(args, lookups=1, misses=1, lookup_ms=elapsed)
+  if len(prompt) > vdb.DIMENSION_TEXT:
+    return generate()
+  store = lambda answer: cache.store(entry_id(model, prompt, opts), model, options_hash(opts), prompt, answer, vector, cfg["ttl"])
+  return Recorder(args, store, generate())
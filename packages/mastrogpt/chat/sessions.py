@@ -0,0 +1,103 @@
+import sys, json, time, zlib, array, secrets
+import rdb
+
+# multi turn sessions: the context (token ids) returned by ollama in the last chunk
+# is saved as a compressed int32 array and sent back with the next prompt,
+# so ollama can reuse its kv cache instead of prefilling the whole conversation.
+# the session id is carried in the state as <model>#<session>
+
+TTL = 3600
+MAX_TOKENS = 32768
+MAX_SESSIONS = 1000
+
+def split(state):
+  (model, _, session) = state.partition("#")
+  return (model, session)
+
+def join(model, session):
+  return f"{model}#{session}" if session else model
+
+def new(args):
+  (rd, _) = rdb.connect(args)
+  return secrets.token_hex(8) if rd else ""
+
+def pack(context):
+  arr = array.array("i", context)
+  if sys.byteorder == "big":
+    arr.byteswap()
+  return zlib.compress(arr.tobytes())
+
+def unpack(data):
+  arr = array.array("i")
+  arr.frombytes(zlib.decompress(data))
+  if sys.byteorder == "big":
+    arr.byteswap()
+  return arr.tolist()
+
+def options(args):
+  return {
+    "ttl": int(args.get("CHAT_SESSION_TTL") or TTL),
+    "max_tokens": int(args.get("CHAT_SESSION_MAX_TOKENS") or MAX_TOKENS),
+    "max_sessions": int(args.get("CHAT_SESSION_MAX") or MAX_SESSIONS)
+  }
+
+def load(args, session):
+  (rd, prefix) = rdb.connect(args)
+  if not rd or not session:
+    return None
+  try:
+    data = rd.get(f"{prefix}CTX:{session}")
+    return unpack(data) if data else None
+  except Exception as e:
+    print("session:", e)
+    return None
+
+def save(args, session, context):
+  (rd, prefix) = rdb.connect(args)
+  if not rd or not session:
+    return
+  cfg = options(args)
+  name = f"{prefix}CTX:{session}"
+  index = f"{prefix}CTX:index"
+  # a conversation too long is evicted, the next turn starts from scratch
+  if len(context) > cfg["max_tokens"]:
+    rd.delete(name)
+    rd.zrem(index, name)
+    return
+  now = time.time()
+  pipe = rd.pipeline()
+  pipe.setex(name, cfg["ttl"], pack(context))
+  pipe.zadd(index, {name: now})
+  pipe.zremrangebyscore(index, 0, now - cfg["ttl"])
+  pipe.zrange(index, 0, -cfg["max_sessions"] - 1)
+  old = pipe.execute()[-1]
+  if old:
+    pipe = rd.pipeline()
+    pipe.delete(*old)
+    pipe.zrem(index, *old)
+    pipe.execute()
+
+class Recorder:
+  """
+  Pass through the lines of a generation, and save the context of the last one.
+  """
+  def __init__(self, args, session, lines):
+    self.args = args
+    self.session = session
+    self.lines = lines
+
+  def __iter__(self):
+    for line in self.lines:
+      yield line
+      if not self.session or not isinstance(line, bytes) or b'"context"' not in line:
+        continue
+      try:
+        jo = json.loads(line)
+        if jo.get("done") and jo.get("context"):
+          save(self.args, self.session, jo["context"])
+      except Exception as e:
+        print("session:", e)
+
+  def close(self):
+    if hasattr(self.lines, "close"):
+      self.lines.close()
@@ -0,0 +1,250 @@
+import time, secrets, threading
+import rdb, respcache
+
+# coalesce identical generations running at the same time, also across containers.
+# the first caller takes a lock in redis and appends every upstream line to a redis stream;
+# the other callers read the stream from the beginning, so they get all the tokens,
+# including the ones already emitted, then follow it until the end marker.
+# if the leader fails before the first token the followers fall back to their own generation.
+# the lock expires after LOCK_TTL seconds and the leader extends it every LOCK_TTL/3 while generating:
+# if it is lost (redis restarted, the leader was frozen) the leader stops publishing,
+# as another one may have taken over the stream.
+# followers count themselves in FLIGHT:<key>:followers: when the client of the leader goes away
+# (disconnect, `!stop`, budget) and someone is following, the upstream is not closed,
+# the rest of the generation is read and published for them.
+# the draining is waited by the invocation of the leader (join()), as a container is paused
+# when its activation ends: after DRAIN seconds the upstream is closed and the followers
+# fall back to their own generation.
+
+LOCK_TTL = 30
+STREAM_TTL = 60
+BLOCK_MS = 1000
+WAIT = 120
+DRAIN = 60
+
+# leaders draining for their followers
+draining = []
+lock = threading.Lock()
+
+UNLOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: lock, followers
+RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+  redis.call('pexpire', KEYS[2], ARGV[2])
+  return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def names(prefix, key):
+  return (f"{prefix}FLIGHT:{key}:lock", f"{prefix}FLIGHT:{key}")
+
+def followers(name):
+  return f"{name}:followers"
+
+class Renewal:
+  """
+  Extend the lock while leading, from a thread so also while a token is slow to come.
+  """
+  def __init__(self, rd, lock, name, owner):
+    self.rd = rd
+    self.lock = lock
+    self.name = name
+    self.owner = owner
+    self.lost = False
+    self.stopped = threading.Event()
+    threading.Thread(target=self.run, daemon=True).start()
+
+  def run(self):
+    while not self.stopped.wait(LOCK_TTL / 3):
+      try:
+        if not self.rd.eval(RENEW, 2, self.lock, followers(self.name), self.owner, int(LOCK_TTL * 1000)):
+          print("singleflight: lock lost, not publishing")
+          self.lost = True
+          return
+      except Exception as e:
+        print("singleflight:", e)
+
+  def stop(self):
+    self.stopped.set()
+
+class Leader:
+  """
+  Pass through the upstream lines, publishing them for the followers while holding the lock.
+  """
+  def __init__(self, rd, lock, name, owner, lines):
+    self.rd = rd
+    self.lock = lock
+    self.name = name
+    self.owner = owner
+    self.lines = lines
+    self.renewal = None
+    self.detached = False
+    self.drained = threading.Event()
+
+  def publish(self, line):
+    if isinstance(line, str):
+      line = line.encode("utf-8")
+    if not self.renewal.lost:
+      self.rd.xadd(self.name, {"line": line})
+    return line
+
+  def finish(self, status):
+    self.renewal.stop()
+    try:
+      if not self.renewal.lost:
+        pipe = self.rd.pipeline()
+        pipe.xadd(self.name, {"end": status})
+        pipe.expire(self.name, STREAM_TTL)
+        pipe.delete(followers(self.name))
+        pipe.execute()
+        self.rd.eval(UNLOCK, 1, self.lock, self.owner)
+    except Exception as e:
+      print("singleflight:", e)
+    finally:
+      self.drained.set()
+
+  def followed(self):
+    try:
+      return not self.renewal.lost and int(self.rd.get(followers(self.name)) or 0) > 0
+    except Exception as e:
+      print("singleflight:", e)
+      return False
+
+  def drain(self, it):
+    # the client of the leader went away: finish the generation for the followers
+    status = b"error"
+    try:
+      for line in it:
+        self.publish(line)
+      status = b"done"
+    except Exception as e:
+      print("singleflight:", e)
+    finally:
+      self.finish(status)
+      if hasattr(it, "close"):
+        it.close()
+
+  def __iter__(self):
+    status = b"error"
+    drained = False
+    self.renewal = Renewal(self.rd, self.lock, self.name, self.owner)
+    it = iter(self.lines)
+    try:
+      for line in it:
+        line = self.publish(line)
+        try:
+          yield line
+        except GeneratorExit:
+          if self.detached or self.followed():
+            print("singleflight: client gone, draining for the followers")
+            drained = True
+            self.drain(it)
+          raise
+      status = b"done"
+    finally:
+      if not drained:
+        self.finish(status)
+
+  def close(self):
+    # with followers the upstream stays open, the rest is drained when the iteration is closed
+    if self.renewal is not None and not self.drained.is_set() and self.followed():
+      self.detached = True
+      with lock:
+        draining.append(self)
+      return
+    if hasattr(self.lines, "close"):
+      self.lines.close()
+
+class Follower:
+  """
+  Replay the lines published by the leader, or fall back to generate().
+  """
+  def __init__(self, rd, lock, name, generate, wait=WAIT):
+    self.rd = rd
+    self.lock = lock
+    self.name = name
+    self.generate = generate
+    self.wait = wait
+    self.lines = None
+    self.closed = False
+    self.sent = 0
+
+  def follow(self):
+    last = "0"
+    deadline = time.time() + self.wait
+    while not self.closed:
+      res = self.rd.xread({self.name: last}, block=BLOCK_MS, count=256)
+      if not res:
+        # nothing new: give up if the leader is gone or too slow
+        if not self.rd.exists(self.lock) or time.time() > deadline:
+          return False
+        continue
+      deadline = time.time() + self.wait
+      for (id, fields) in res[0][1]:
+        last = id
+        if b"end" in fields:
+          return fields[b"end"] == b"done"
+        self.sent += 1
+        yield fields[b"line"]
+    return True
+
+  def __iter__(self):
+    self.sent = 0
+    done = yield from self.follow()
+    if done or self.closed:
+      return
+    if self.sent > 0:
+      # a new generation would not continue the tokens already sent
+      yield "\n[generation interrupted]\n"
+      return
+    print("singleflight: leader failed, generating")
+    self.lines = self.generate()
+    yield from self.lines
+
+  def close(self):
+    self.closed = True
+    if hasattr(self.lines, "close"):
+      self.lines.close()
+
+def join(args):
+  """
+  Wait for the leaders draining for their followers, closing the upstream of the ones still draining after DRAIN seconds.
+  """
+  with lock:
+    leaders = list(draining)
+    draining.clear()
+  deadline = time.time() + float(args.get("CHAT_SINGLEFLIGHT_DRAIN") or DRAIN)
+  for leader in leaders:
+    if not leader.drained.wait(max(0, deadline - time.time())):
+      print("singleflight: draining too long, closing")
+      if hasattr(leader.lines, "close"):
+        leader.lines.close()
+      # the end marker for the followers
+      leader.drained.wait(1)
+
+def coalesce(args, model, prompt, opts, generate):
+  (rd, prefix) = rdb.connect(args)
+  if not rd or str(args.get("CHAT_SINGLEFLIGHT", "true")).lower() in ["0", "false", "no"]:
+    return generate()
+  (lock, name) = names(prefix, respcache.key(model, prompt, opts))
+  owner = secrets.token_hex(8)
+  try:
+    if rd.set(lock, owner, nx=True, ex=LOCK_TTL):
+      rd.delete(name, followers(name))
+      return Leader(rd, lock, name, owner, generate())
+    pipe = rd.pipeline()
+    pipe.incr(followers(name))
+    pipe.expire(followers(name), LOCK_TTL)
+    pipe.execute()
+  except Exception as e:
+    print("singleflight:", e)
+    return generate()
+  print(f"singleflight: following {model}")
+  return Follower(rd, lock, name, generate)
@@ -0,0 +1,305 @@
+import os
+from pymilvus import MilvusClient, DataType, Function, FunctionType, AnnSearchRequest, RRFRanker
+import time, random
+import embeddings
+
+DIMENSION_TEXT=4096
+LIMIT=10
+BATCH=1000
+
+UPSERT_BATCH=500
+# chunks of long texts, in characters; the limit of the text field is in bytes
+CHUNK=2000
+OVERLAP=200
+
+def chunks(text, size=CHUNK, overlap=OVERLAP):
+  """
+  Split the text in chunks of about size characters, each one repeating the last overlap
+  characters of the previous one, cut at a whitespace when possible and never over DIMENSION_TEXT bytes.
+  The overlap is at most half a chunk, so the text is split in at most about 2 * len(text) / size chunks.
+  """
+  size = max(1, size)
+  overlap = max(0, min(overlap, size // 2))
+  text = text.strip()
+  out = []
+  start = 0
+  while start < len(text):
+    end = min(len(text), start + size)
+    if end < len(text):
+      cut = text.rfind(" ", start + overlap + 1, end)
+      end = cut if cut > 0 else end
+    while len(text[start:end].encode('utf-8')) > DIMENSION_TEXT:
+      end = start + (end - start) * 3 // 4
+    out.append(text[start:end].strip())
+    if end >= len(text):
+      break
+    # a chunk shortened to fit the bytes moves on by half of it at least
+    start = max(start + max(1, (end - start) // 2), end - overlap)
+  return [chunk for chunk in out if chunk]
+
+def like(search):
+  """
+  A filter expression matching the texts containing search: the like wildcards
+  % and _ are escaped to match themselves, then the pattern is quoted.
+  """
+  pattern = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  literal = pattern.replace('\\', '\\\\').replace('"', '\\"')
+  return f'text like "%{literal}%"'
+
+# optional dense field: when VDB_EMBED_MODEL is set, new collections also get a "dense" vector
+# filled with the ollama embeddings of the text, and searches combine the BM25 and the dense results
+# with reciprocal rank fusion. Embeddings are requested and cached by embeddings.py.
+RRF_K=60
+
+# clients and collection metadata are kept by the warm container:
+# clients by (uri, token, db_name), the collection names and schemas by client,
+# updated when a collection is created or dropped here; the names are listed again
+# after NAMES_TTL seconds, to see the collections created or dropped by other containers
+clients = {}
+names = {}
+NAMES_TTL = 30
+schemas = {}
+# row counts by (client, collection), until their expiration
+counts = {}
+COUNT_TTL = 10
+
+def connect(args):
+  uri = f"http://{args.get("MILVUS_HOST", os.getenv("MILVUS_HOST"))}"
+  token = args.get("MILVUS_TOKEN", os.getenv("MILVUS_TOKEN"))
+  db_name = args.get("MILVUS_DB_NAME", os.getenv("MILVUS_DB_NAME"))
+  key = (uri, token, db_name)
+  if key not in clients:
+    clients[key] = MilvusClient(uri=uri, token=token, db_name=db_name)
+  return (key, clients[key])
+
+class VectorDB:
+
+  def __init__(self, args, collection):
+      (self.key, self.client) = connect(args)
+      self.args = args
+      self.embed_model = args.get("VDB_EMBED_MODEL", os.getenv("VDB_EMBED_MODEL"))
+      self.ensure(collection)
+
+  def embed(self, texts):
+    """
+    The dense vectors of the texts, from the cache or from ollama in batches.
+    """
+    (bufs, _) = embeddings.vectors(self.args, self.embed_model, texts)
+    return [embeddings.unpack(buf).tolist() for buf in bufs]
+
+  def dense(self):
+    return any(field.get("name") == "dense" for field in self.describe().get("fields", []))
+
+  def rows(self, texts):
+    rows = [{"id": embeddings.text_id(text), "text": text} for text in texts]
+    if self.dense():
+      for (row, vector) in zip(rows, self.embed(texts)):
+        row["dense"] = vector
+    return rows
+
+  def collections(self, refresh=False):
+    (expires, found) = names.get(self.key, (0.0, None))
+    if refresh or found is None or time.time() >= expires:
+      found = self.client.list_collections()
+      names[self.key] = (time.time() + NAMES_TTL, found)
+    return found
+
+  def describe(self):
+    key = (self.key, self.collection)
+    if key not in schemas:
+      schemas[key] = self.client.describe_collection(self.collection)
+    return schemas[key]
+
+  def invalidate(self, collection):
+    names.pop(self.key, None)
+    schemas.pop((self.key, collection), None)
+    counts.pop((self.key, collection), None)
+
+  def destroy(self, collection=None):
+    collection = collection or self.collection
+    self.client.drop_collection(collection)
+    self.invalidate(collection)
+    out = f"Dropped {collection}\n"
+    return out + self.setup("default")
+
+  def ensure(self, collection):
+    self.collection = collection
+    if not collection in self.collections():
+      # a schema seen before belongs to a collection dropped elsewhere
+      schemas.pop((self.key, collection), None)
+      self.create(collection)
+      self.collections().append(collection)
+
+  def create(self, collection):
+    schema = self.client.create_schema()
+    schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
+    schema.add_field(field_name="text", datatype=DataType.VARCHAR, max_length=DIMENSION_TEXT, enable_analyzer=True)
+    schema.add_field(field_name="sparse", datatype=DataType.SPARSE_FLOAT_VECTOR)
+    bm25_function = Function(name="text_bm25_emb", input_field_names=["text"], output_field_names=["sparse"], function_type=FunctionType.BM25)
+    schema.add_function(bm25_function)
+    if self.embed_model:
+      dimension = len(self.embed(["dimension"])[0])
+      schema.add_field(field_name="dense", datatype=DataType.FLOAT_VECTOR, dim=dimension)
+
+    index_params = self.client.prepare_index_params()
+    index_params.add_index(
+        field_name="sparse",
+        index_type="SPARSE_INVERTED_INDEX",
+        metric_type="BM25",
+        params={ "inverted_index_algo": "DAAT_MAXSCORE", "bm25_k1": 1.2, "bm25_b": 0.75}
+      )
+    if self.embed_model:
+      index_params.add_index(field_name="dense", index_type="AUTOINDEX", metric_type="COSINE")
+    self.client.create_collection(collection_name=collection, schema=schema, index_params=index_params)
+    print("collection_name=", collection)
+
+  def setup(self, collection):
+    # the list shown is fresh, also for the collections created elsewhere
+    self.collections(refresh=True)
+    self.ensure(collection)
+    ls = self.collections()
+    res =  f"Collections: {" ".join(ls)}\nCurrent: {self.collection}" 
+    count = self.count()
+    res += f"\nCount: {count}"
+    return res
+  
+  def insert(self, text):
+    try:
+      res = self.client.insert(self.collection, self.rows([text]))
+      counts.pop((self.key, self.collection), None)
+      n = res.get('insert_count', 0)
+      ids = [str(x) for x in res.get('ids', [])]
+      out = f"Inserted {n}: {",".join(ids)})"
+      return out
+    except Exception as e:
+      return(f"Error: {str(e)}")
+  
+  def upsert_many(self, texts, batch=UPSERT_BATCH):
+    """
+    Upsert the texts in batches, so the same text is stored once.
+    Yield the number of rows written after each batch.
+    """
+    done = 0
+    for i in range(0, len(texts), batch):
+      # the same id twice in a batch is refused
+      rows = list({row["id"]: row for row in self.rows(texts[i:i + batch])}.values())
+      res = self.client.upsert(self.collection, rows)
+      done += res.get('upsert_count', len(rows))
+      yield done
+    counts.pop((self.key, self.collection), None)
+
+  def count(self, exact=False):
+    """
+    The number of rows from the collection statistics, cached for COUNT_TTL seconds.
+    It can miss the rows not yet flushed: exact counts them all with a count(*) query.
+    """
+    key = (self.key, self.collection)
+    now = time.time()
+    try:
+      if not exact and key in counts and counts[key][0] > now:
+        return str(counts[key][1])
+      if exact:
+        res = self.client.query(collection_name=self.collection, filter="", output_fields=["count(*)"])
+        count = int(res[0]["count(*)"])
+      else:
+        count = int(self.client.get_collection_stats(self.collection).get("row_count", 0))
+      # only a fetched count starts a new period
+      counts[key] = (now + COUNT_TTL, count)
+      return str(count)
+    except Exception as e:
+      return f"unknown ({e})"
+
+  def full_text_search(self, query, limit=LIMIT):
+    search_params = { 'params': {'drop_ratio_search': 0.2} }
+    hits = self.client.search(collection_name=self.collection, 
+      limit=limit, search_params=search_params,
+      data=[query], anns_field='sparse', output_fields=['text'])
+    out = []
+    for hit in hits:
+      #hit = hits[0]  # Get the first hit
+      for rec in hit:
+        #rec = hit[0]
+        dist = rec.get('distance', 0.0)
+        text = rec.get('entity', {}).get('text', "")
+        out.append((dist, text))
+    return out
+
+  def dense_search(self, query, limit=LIMIT):
+    hits = self.client.search(collection_name=self.collection, limit=limit,
+      search_params={"metric_type": "COSINE"},
+      data=self.embed([query]), anns_field='dense', output_fields=['text'])
+    return [(rec.get('distance', 0.0), rec.get('entity', {}).get('text', "")) for hit in hits for rec in hit]
+
+  def hybrid_search(self, query, limit=LIMIT):
+    """
+    BM25 and dense searches in a single request, merged by reciprocal rank fusion.
+    Without the dense field it is a full text search.
+    """
+    if not self.dense():
+      return self.full_text_search(query, limit)
+    reqs = [
+      AnnSearchRequest(data=[query], anns_field="sparse", param={"drop_ratio_search": 0.2}, limit=limit),
+      AnnSearchRequest(data=self.embed([query]), anns_field="dense", param={"metric_type": "COSINE"}, limit=limit)
+    ]
+    hits = self.client.hybrid_search(collection_name=self.collection, reqs=reqs,
+      ranker=RRFRanker(RRF_K), limit=limit, output_fields=['text'])
+    return [(rec.get('distance', 0.0), rec.get('entity', {}).get('text', "")) for hit in hits for rec in hit]
+
+  def benchmark(self, queries=20, limit=LIMIT, seed=0):
+    """
+    Compare latency and recall of the sparse, dense and hybrid searches.
+    The queries are half of the words of sampled texts, picked at random:
+    a search finds a query when its text is in the first limit results.
+    """
+    rnd = random.Random(seed)
+    texts = [ent.get("text", "") for ent in self.client.query(collection_name=self.collection, filter="",
+      limit=queries, output_fields=["text"])]
+    cases = []
+    for text in texts:
+      words = text.split()
+      picked = sorted(rnd.sample(range(len(words)), max(1, len(words) // 2)))[:30] if words else []
+      cases.append((" ".join(words[i] for i in picked) or text, text))
+    modes = [("sparse", self.full_text_search)]
+    if self.dense():
+      modes += [("dense", self.dense_search), ("hybrid", self.hybrid_search)]
+    out = f"{len(cases)} queries, limit {limit}\n"
+    for (name, search) in modes:
+      times = []
+      found = 0
+      for (query, text) in cases:
+        start = time.perf_counter()
+        res = search(query, limit)
+        times.append((time.perf_counter() - start) * 1000)
+        found += 1 if any(hit == text for (_, hit) in res) else 0
+      times.sort()
+      p50 = times[len(times) // 2] if times else 0.0
+      p95 = times[min(len(times) - 1, int(len(times) * 0.95))] if times else 0.0
+      out += f"{name:<7} p50={p50:.1f}ms p95={p95:.1f}ms recall@{limit}={found / len(cases) if cases else 0:.2f}\n"
+    return out
+
+  def substring_search(self, search, limit=LIMIT):
+    """
+    The (id, text) of the texts containing search, at most limit (all if limit <= 0).
+    The match runs in milvus, the rows come back in batches of BATCH.
+    """
+    expr = like(search)
+    if 0 < limit <= BATCH:
+      res = self.client.query(collection_name=self.collection, filter=expr, limit=limit, output_fields=["id", "text"])
+      return [(ent.get('id'), ent.get('text', "")) for ent in res]
+    cur = self.client.query_iterator(collection_name=self.collection, filter=expr,
+              batch_size=BATCH, limit=limit if limit > 0 else -1, output_fields=["id", "text"])
+    out = []
+    try:
+      res = cur.next()
+      while len(res) > 0:
+        out.extend((ent.get('id'), ent.get('text', "")) for ent in res)
+        res = cur.next()
+    finally:
+      cur.close()
+    return out
+
+  def remove_by_substring(self, inp):
+    # a single delete by filter expression, milvus finds the rows
+    res = self.client.delete(collection_name=self.collection, filter=like(inp))
+    counts.pop((self.key, self.collection), None)
+    return res['delete_count'] if isinstance(res, dict) else len(res)
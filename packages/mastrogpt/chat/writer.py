@@ -0,0 +1,111 @@
+import json, struct, time, asyncio
+
+# coalesce the token messages sent to the streamer:
+# outputs are merged until MAX_BYTES are pending or MAX_DELAY passed since the last send,
+# so the streamer gets one frame (one syscall) for many tokens.
+# pending output is flushed on the next token, a state change or close,
+# and by a timer on the event loop, so a token is delayed at most MAX_DELAY even when the next one is slow.
+
+MAX_BYTES = 4096
+MAX_DELAY = 0.02
+
+# ndjson: one json message per line
+# length: 4 bytes big endian length followed by the json message
+# raw: json messages concatenated, as before
+FRAMINGS = ["ndjson", "length", "raw"]
+
+def options(args):
+  framing = args.get("STREAM_FRAMING") or "ndjson"
+  if framing not in FRAMINGS:
+    framing = "ndjson"
+  return {
+    "framing": framing,
+    "max_bytes": int(args.get("STREAM_MAX_BYTES") or MAX_BYTES),
+    "max_delay": float(args.get("STREAM_MAX_DELAY_MS") or MAX_DELAY * 1000) / 1000,
+    "debug": str(args.get("STREAM_DEBUG", "")).lower() in ["1", "true", "yes"]
+  }
+
+class FrameWriter:
+
+  def __init__(self, sock, framing="ndjson", max_bytes=MAX_BYTES, max_delay=MAX_DELAY, debug=False, channel=None):
+    self.sock = sock
+    # on a shared connection every message carries its channel, and raw json cannot be split
+    self.channel = channel
+    self.framing = "ndjson" if channel and framing == "raw" else framing
+    self.max_bytes = max_bytes
+    self.max_delay = max_delay
+    self.debug = debug
+    self.pending = []
+    self.size = 0
+    self.last = 0.0
+    self.frames = 0
+    self.messages = 0
+    self.timer = None
+
+  def frame(self, msg):
+    if self.channel:
+      msg = dict(msg, channel=self.channel)
+    buf = json.dumps(msg).encode("utf-8")
+    if self.framing == "length":
+      return struct.pack(">I", len(buf)) + buf
+    if self.framing == "ndjson":
+      return buf + b"\n"
+    return buf
+
+  def send(self, msg):
+    buf = self.frame(msg)
+    if self.debug:
+      print(buf)
+    self.sock.sendall(buf)
+    self.frames += 1
+    self.last = time.monotonic()
+
+  def write(self, msg):
+    self.messages += 1
+    if "state" in msg or "output" not in msg:
+      # keep the order: pending output goes before the state
+      self.flush()
+      self.send(msg)
+      return
+    out = msg["output"]
+    self.pending.append(out)
+    # size in characters, close enough to bytes to decide when to flush
+    self.size += len(out)
+    if self.size >= self.max_bytes or time.monotonic() - self.last >= self.max_delay:
+      self.flush()
+    else:
+      self.schedule()
+
+  def schedule(self):
+    if self.timer is not None:
+      return
+    try:
+      loop = asyncio.get_running_loop()
+    except RuntimeError:
+      # not in a loop: flushed only on the next write
+      return
+    delay = max(0.0, self.max_delay - (time.monotonic() - self.last))
+    self.timer = loop.call_later(delay, self.tick)
+
+  def tick(self):
+    self.timer = None
+    try:
+      self.flush()
+    except (ConnectionError, OSError):
+      # the next write fails too and stops the relay
+      pass
+
+  def flush(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if self.pending:
+      self.send({"output": "".join(self.pending)})
+      self.pending = []
+      self.size = 0
+
+  def close(self):
+    self.flush()
+    if self.debug:
+      print(f"frames={self.frames} messages={self.messages}")
+    self.sock.close()
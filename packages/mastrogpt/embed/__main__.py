@@ -0,0 +1,10 @@
+#--kind python:default
+#--web true
+#--param OLLAMA_API_HOST "$OLLAMA_API_HOST"
+#--param OLLAMA_EMBED_MODEL "$OLLAMA_EMBED_MODEL"
+#--param REDIS_URL "$REDIS_URL"
+#--param REDIS_PREFIX "$REDIS_PREFIX"
+
+import embed
+def main(args):
+  return { "body": embed.embed(args) }
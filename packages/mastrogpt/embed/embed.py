@@ -0,0 +1,39 @@
+import os, base64
+import embeddings
+
+# embeddings from ollama /api/embed, requested and cached by embeddings.py
+# (shared with the loader and the chat), and returned as a base64
+# float32 (little endian) matrix instead of lists of json floats.
+
+MODEL = "nomic-embed-text"
+
+USAGE = """Welcome to the embeddings.
+Write a text to see its embedding.
+Post `inputs` (a list of texts) to embed many texts at once:
+the result `vectors` is a base64 float32 matrix of `shape` [len(inputs), dimension].
+"""
+
+def embed(args):
+  model = args.get("model") or args.get("OLLAMA_EMBED_MODEL") or os.getenv("OLLAMA_EMBED_MODEL") or MODEL
+  texts = args.get("inputs") or []
+  inp = args.get("input", "")
+  if not texts and inp == "":
+    return {"output": USAGE}
+  if not texts:
+    texts = [inp]
+
+  try:
+    (bufs, hits) = embeddings.vectors(args, model, texts)
+  except Exception as e:
+    return {"output": f"Error: {str(e)}"}
+
+  dimension = len(bufs[0]) // 4 if bufs else 0
+  out = f"model: {model}\ninputs: {len(texts)} cached: {hits}\ndimension: {dimension}\n"
+  if inp and not args.get("inputs"):
+    out += f"vector: {[round(x, 4) for x in embeddings.unpack(bufs[0])[:8]]}...\n"
+  return {
+    "output": out,
+    "model": model,
+    "shape": [len(bufs), dimension],
+    "vectors": base64.b64encode(b"".join(bufs)).decode("ascii")
+  }
@@ -0,0 +1,115 @@
+import os, sys, array, hashlib, struct
+import requests, redis
+from requests.adapters import HTTPAdapter
+
+# embeddings from ollama /api/embed, many inputs per request, for the embed, loader and chat actions.
+# the actions are deployed as separate zips, so this file is copied in each of them: keep the copies equal.
+# vectors are cached as float32 buffers, keyed by model and text_id(text):
+# in redis (when REDIS_URL is set) and the last MEMORY ones also in the warm container.
+
+BATCH = 64
+TTL = 7 * 86400
+MEMORY = 10000
+POOL_SIZE = 10
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 120
+
+session = None
+rd = None
+prefix = ""
+memory = {}
+
+def text_id(text):
+  # the ids of the vdb rows, also the cache keys
+  sha256 = hashlib.sha256(text.encode('utf-8')).digest()
+  return struct.unpack('>q', sha256[:8])[0]  # '>q' = big-endian signed 64-bit
+
+def url(args, cmd, host=None):
+  apihost = host or args.get("OLLAMA_API_HOST", os.getenv("OLLAMA_API_HOST", "")).split(",")[0]
+  return f"{apihost}/api/{cmd}"
+
+def connect(args):
+  global session, rd, prefix
+  if not session:
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+  if not rd:
+    redis_url = args.get("REDIS_URL") or os.getenv("REDIS_URL")
+    if redis_url:
+      rd = redis.from_url(redis_url)
+      prefix = args.get("REDIS_PREFIX") or os.getenv("REDIS_PREFIX") or ""
+  return rd
+
+def key(model, text):
+  return f"{prefix}EMBED:{model}:{text_id(text)}"
+
+def pack(vector):
+  arr = array.array("f", vector)
+  if sys.byteorder == "big":
+    arr.byteswap()
+  return arr.tobytes()
+
+def unpack(data):
+  arr = array.array("f")
+  arr.frombytes(data)
+  if sys.byteorder == "big":
+    arr.byteswap()
+  return arr
+
+def fetch(args, model, texts, host=None):
+  """
+  Embed the texts with ollama, BATCH inputs per request. Return float32 buffers.
+  """
+  batch = int(args.get("OLLAMA_EMBED_BATCH") or BATCH)
+  timeout = (CONNECT_TIMEOUT, float(args.get("OLLAMA_EMBED_TIMEOUT") or READ_TIMEOUT))
+  out = []
+  for i in range(0, len(texts), batch):
+    msg = {"model": model, "input": texts[i:i + batch]}
+    res = session.post(url(args, "embed", host), json=msg, timeout=timeout).json()
+    if "error" in res:
+      raise RuntimeError(res["error"])
+    out.extend(pack(vector) for vector in res.get("embeddings", []))
+  return out
+
+def remember(model, text, buf):
+  memory[(model, text_id(text))] = buf
+  # forget the oldest
+  for old in list(memory)[:max(0, len(memory) - MEMORY)]:
+    del memory[old]
+
+def vectors(args, model, texts, host=None):
+  """
+  Return (float32 buffers, number of cache hits) for the texts.
+  """
+  connect(args)
+  res = [memory.get((model, text_id(text))) for text in texts]
+  missing = [i for (i, buf) in enumerate(res) if buf is None]
+  if rd and missing:
+    try:
+      for (i, buf) in zip(missing, rd.mget([key(model, texts[i]) for i in missing])):
+        if buf is not None:
+          res[i] = buf
+          remember(model, texts[i], buf)
+    except Exception as e:
+      print("embeddings:", e)
+    missing = [i for i in missing if res[i] is None]
+  hits = len(texts) - len(missing)
+  if missing:
+    # embed each distinct text once
+    unique = list(dict.fromkeys(texts[i] for i in missing))
+    found = dict(zip(unique, fetch(args, model, unique, host)))
+    for i in missing:
+      res[i] = found[texts[i]]
+    for (text, buf) in found.items():
+      remember(model, text, buf)
+    if rd:
+      try:
+        pipe = rd.pipeline()
+        for (text, buf) in found.items():
+          pipe.setex(key(model, text), TTL, buf)
+        pipe.execute()
+      except Exception as e:
+        print("embeddings:", e)
+  return (res, hits)
@@ -5,6 +5,10 @@
 #--param MILVUS_PORT "$MILVUS_PORT"
 #--param MILVUS_DB_NAME "$MILVUS_DB_NAME"
 #--param MILVUS_TOKEN "$MILVUS_TOKEN"
+#--param OLLAMA_API_HOST "$OLLAMA_API_HOST"
+#--param VDB_EMBED_MODEL "$VDB_EMBED_MODEL"
+#--param REDIS_URL "$REDIS_URL"
+#--param REDIS_PREFIX "$REDIS_PREFIX"
 
 import loader
 def main(args):
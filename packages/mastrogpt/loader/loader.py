@@ -1,3 +1,4 @@
+import json, time, base64, socket
 import vdb
 
 USAGE = f"""Welcome to the Vector DB Loader.
@@ -5,11 +6,68 @@ Write text to insert in the DB.
 Use `@[<coll>]` to select/create a collection and show the collections.
 Use `*<string>` to full text search the <string> in the DB.
 Use `%<string>` to substring search the <string> in the DB.
+Use `&[<queries>]` to compare latency and recall of sparse, dense and hybrid search.
 Use `#<limit>`  to change the limit of searches.
+Use `?` to count exactly the records in the collection (slow on large collections).
 Use `!<substr>` to remove text with `<substr>` in collection.
 Use `!![<collection>]` to remove `<collection>` (default current) and switch to default.
+Post `documents` (a list of texts) or `files` (a list of {{name, base64}}) to load them in bulk.
 """
 
+def documents(args):
+  """
+  The texts of a bulk load: the `documents` and the decoded `files`, as sent to the upload action.
+  """
+  docs = [str(doc) for doc in args.get("documents") or []]
+  for file in args.get("files") or []:
+    data = file.get("base64", "")
+    if data.startswith("data:"):
+      # a data url: data:<type>;base64,<data>
+      data = data.split(",", 1)[-1]
+    docs.append(base64.b64decode(data).decode("utf-8", "replace"))
+  return docs
+
+class Progress:
+  """
+  Progress messages, to the streamer if there is one, and to the log.
+  """
+  def __init__(self, args):
+    self.sock = None
+    addr = (args.get("STREAM_HOST", ""), int(args.get("STREAM_PORT") or "0"))
+    if addr[0] and addr[1]:
+      self.sock = socket.create_connection(addr)
+
+  def send(self, out):
+    print(out, end="")
+    if self.sock is not None:
+      self.sock.sendall(json.dumps({"output": out}).encode("utf-8") + b"\n")
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+
+def ingest(args, db, docs):
+  """
+  Split the documents in overlapping chunks and upsert them in batches, reporting the progress.
+  """
+  # chunks of at least a character, overlapping by less than half of them
+  size = max(1, int(args.get("chunk") or vdb.CHUNK))
+  overlap = max(0, min(int(args.get("overlap") or vdb.OVERLAP), size // 2))
+  batch = int(args.get("batch") or vdb.UPSERT_BATCH)
+  texts = [chunk for doc in docs for chunk in vdb.chunks(doc, size, overlap)]
+  start = time.time()
+  progress = Progress(args)
+  try:
+    progress.send(f"Loading {len(docs)} documents in {len(texts)} chunks.\n")
+    done = 0
+    for done in db.upsert_many(texts, batch):
+      elapsed = time.time() - start
+      progress.send(f"{done}/{len(texts)} rows, {done / elapsed if elapsed else 0:.0f} rows/s\n")
+  finally:
+    progress.close()
+  elapsed = time.time() - start
+  return f"Loaded {done} rows from {len(docs)} documents in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} rows/s)."
+
 def loader(args):
   print(args)
   collection = "default"
@@ -27,8 +85,12 @@ def loader(args):
   db = vdb.VectorDB(args, collection)
   inp = str(args.get('input', ""))
 
+  docs = documents(args)
+  # bulk load
+  if len(docs) > 0:
+    out = ingest(args, db, docs)
   # select collection
-  if inp.startswith("@"):
+  elif inp.startswith("@"):
     out = ""
     if len(inp) > 1:
        collection = inp[1:]
@@ -40,6 +102,9 @@ def loader(args):
        limit = int(inp[1:])
     except: pass
     out = f"Search limit is now {limit}.\n"
+  # exact count
+  elif inp == "?":
+    out = f"Count: {db.count(exact=True)}"
   # run a query
   elif inp.startswith("*"):
     search = inp[1:]
@@ -55,13 +120,21 @@ def loader(args):
     search = inp[1:]
     if search == "":
       search = " "
-    res = db.full_text_search(search, limit=limit)
+    # with the dense field BM25 and semantic matches are fused
+    res = db.hybrid_search(search, limit=limit)
     if len(res) > 0:
       out = f"Found:\n"
       for i in res:
         out += f"{i}\n"
     else:
       out = "Not found"
+  # compare the searches
+  elif inp.startswith("&"):
+    try:
+      queries = int(inp[1:] or "20")
+    except ValueError:
+      queries = 20
+    out = db.benchmark(queries, limit)
   # remove a collection
   elif inp.startswith("!!"):
     if len(inp) > 2:
@@ -72,6 +145,9 @@ def loader(args):
   elif inp.startswith("!"):
     count = db.remove_by_substring(inp[1:])
     out = f"Deleted {count} records."    
+  elif len(inp.encode("utf-8")) > vdb.DIMENSION_TEXT:
+    # too long for a single record
+    out = ingest(args, db, [inp])
   elif inp != '':
     out = "Inserted "
     out = db.insert(inp)
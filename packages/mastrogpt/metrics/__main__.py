@@ -0,0 +1,9 @@
+#--kind python:default
+#--web true
+#--param REDIS_URL $REDIS_URL
+#--param REDIS_PREFIX $REDIS_PREFIX
+
+import metrics
+
+def main(args):
+  return { "body": metrics.metrics(args) }
@@ -0,0 +1,77 @@
+import os
+import redis
+
+# read back the histograms written by mastrogpt/chat (meter.py)
+
+METRICS = ["ttft_ms", "itl_ms", "tps", "prefill_ms", "load_ms"]
+
+USAGE = """Generation metrics per model.
+Type `*` to see all the models.
+Type `<prefix>` to see the models starting with <prefix>.
+Type `!<model>` to reset the metrics of a model, `!*` of all the models.
+"""
+
+rd = None
+prefix = "error:"
+
+def quantile(hist, q):
+  """
+  Estimate the q quantile as the upper bound of the bucket reaching it.
+  """
+  count = hist.get("count", 0)
+  if count == 0:
+    return 0.0
+  bounds = sorted((float(k[3:]), v) for (k, v) in hist.items() if k.startswith("le:"))
+  seen = 0
+  for (bound, n) in bounds:
+    seen += n
+    if seen >= q * count:
+      return bound
+  return float("inf")
+
+def load(model, metric):
+  res = rd.hgetall(f"{prefix}METRICS:{model}:{metric}")
+  hist = {}
+  for (k, v) in res.items():
+    k = k.decode("utf-8")
+    hist[k] = float(v) if k == "sum" else int(v)
+  return hist
+
+def show(models):
+  out = ""
+  for model in models:
+    out += f"{model}\n"
+    for metric in METRICS:
+      hist = load(model, metric)
+      count = hist.get("count", 0)
+      if count == 0:
+        continue
+      mean = hist.get("sum", 0.0) / count
+      out += f"  {metric:<11} n={count:<6} mean={mean:<9.1f} p50<={quantile(hist, 0.5):<8g} p95<={quantile(hist, 0.95):g}\n"
+  return out or "No metrics."
+
+def reset(models):
+  for model in models:
+    rd.delete(*[f"{prefix}METRICS:{model}:{metric}" for metric in METRICS])
+    rd.srem(f"{prefix}METRICS:models", model)
+  return f"Reset {len(models)} models."
+
+def metrics(args):
+  global rd, prefix
+  if not rd:
+    rd = redis.from_url(args.get("REDIS_URL", os.getenv("REDIS_URL")))
+    prefix = args.get("REDIS_PREFIX", os.getenv("REDIS_PREFIX"))
+
+  inp = args.get("input", "")
+  models = sorted(m.decode("utf-8") for m in rd.smembers(f"{prefix}METRICS:models"))
+  out = USAGE
+  if inp == "*":
+    out = show(models)
+  elif inp == "!*":
+    out = reset(models)
+  elif inp.startswith("!"):
+    out = reset([m for m in models if m == inp[1:]])
+  elif inp != "":
+    out = show([m for m in models if m.startswith(inp)])
+
+  return { "output": out }
@@ -1,6 +1,8 @@
 #--kind python:default
 #--web true
 #--param OLLAMA_URL "$OLLAMA_URL"
+#--param REDIS_URL "$REDIS_URL"
+#--param REDIS_PREFIX "$REDIS_PREFIX"
 
 import chat
 def main(args):
@@ -1,15 +1,344 @@
-import os, requests
+import os, json, time, socket, hashlib, threading, requests, redis
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 MODEL = "llama3.1:8b"
 
+# responses are cached in redis (if available) for CACHE_TTL seconds
+CACHE_TTL = 3600
+CACHE_MAX_SIZE = 65536
+
+rd = None
+
+# OLLAMA_URL can be a comma separated list of backends:
+# each one is checked (GET /api/tags) at most every HEALTH_TTL seconds, the ones down
+# or without the model are skipped, and among the others the one with less requests
+# in flight is used, the next one if it fails. `!backends` shows their state.
+HEALTH_TTL = 10
+HEALTH_TIMEOUT = 2
+
+lock = threading.Lock()
+health = {}
+inflight = {}
+errors = {}
+
+def cache_key(args, model, prompt, options=None):
+  prefix = args.get("REDIS_PREFIX", os.getenv("REDIS_PREFIX", ""))
+  data = json.dumps([model, prompt, options or {}], sort_keys=True)
+  return f"{prefix}CHAT:{hashlib.sha256(data.encode('utf-8')).hexdigest()}"
+
+def cache(args):
+  global rd
+  url = args.get("REDIS_URL", os.getenv("REDIS_URL"))
+  if not rd and url:
+    rd = redis.from_url(url)
+  return rd
+
+def urls(args):
+  value = args.get("OLLAMA_URL", os.getenv("OLLAMA_URL"))
+  return [b.strip().rstrip("/") for b in str(value).split(",") if b.strip()]
+
+def count(table, base, delta=1):
+  with lock:
+    table[base] = table.get(base, 0) + delta
+
+def mark(base, up, models=None):
+  with lock:
+    health[base] = (time.time() + HEALTH_TTL, up, models)
+
+def check(base):
+  """
+  Return (up, models) of the backend, models is None when unknown.
+  """
+  with lock:
+    (expires, up, models) = health.get(base, (0.0, True, None))
+  if time.time() >= expires:
+    try:
+      tags = requests.get(f"{base}/api/tags", timeout=HEALTH_TIMEOUT).json().get("models", [])
+      (up, models) = (True, set(m.get("name") for m in tags))
+    except Exception as e:
+      print(f"backend {base} down: {e}")
+      (up, models) = (False, None)
+    mark(base, up, models)
+  return (up, models)
+
+def backends(args, model=None):
+  bases = urls(args)
+  if len(bases) > 1:
+    with ThreadPoolExecutor(max_workers=len(bases)) as pool:
+      state = dict(zip(bases, pool.map(check, bases)))
+    usable = [b for b in bases if state[b][0] and (model is None or state[b][1] is None or model in state[b][1])]
+    # if nobody looks usable, try anyway
+    bases = usable or bases
+  with lock:
+    return sorted(bases, key=lambda b: (inflight.get(b, 0), errors.get(b, 0)))
+
+def report(args):
+  out = []
+  for base in urls(args):
+    with lock:
+      (_, up, models) = health.get(base, (0.0, True, None))
+      (n, e) = (inflight.get(base, 0), errors.get(base, 0))
+    names = "?" if models is None else len(models)
+    out.append(f"{base} {'up' if up else 'down'} inflight: {n} errors: {e} models: {names}")
+  return "\n".join(out)
+
+def post(args, msg, timeout=None):
+  error = None
+  for base in backends(args, msg.get("model")):
+    count(inflight, base)
+    try:
+      return requests.post(f"{base}/api/generate", json=msg, stream=False, timeout=timeout).json()
+    except requests.ConnectionError as e:
+      count(errors, base)
+      mark(base, False)
+      error = e
+    finally:
+      count(inflight, base, -1)
+  raise error
+
+def post_lines(args, msg, timeout=None):
+  """
+  Stream the response lines, failing over to the next backend only before the response starts.
+  """
+  error = None
+  for base in backends(args, msg.get("model")):
+    try:
+      res = requests.post(f"{base}/api/generate", json=msg, stream=True, timeout=timeout)
+    except requests.ConnectionError as e:
+      count(errors, base)
+      mark(base, False)
+      error = e
+      continue
+    count(inflight, base)
+    try:
+      yield from res.iter_lines()
+    finally:
+      count(inflight, base, -1)
+      res.close()
+    return
+  raise error
+
+# per request generation options, passed to ollama:
+# num_predict limits the length of the answer, num_ctx the context window,
+# keep_alive how long the model stays loaded after the request
+OPTIONS = ["num_predict", "num_ctx"]
+
+def options(args):
+  opts = {}
+  for key in OPTIONS:
+    value = args.get(key)
+    if value in [None, ""]:
+      continue
+    try:
+      opts[key] = int(value)
+    except (TypeError, ValueError):
+      raise ValueError(f"Invalid {key}: {value!r}, expected an integer.")
+  return opts
+
+def request(model, prompt, options=None, stream=False, keep_alive=None):
+  msg = {"model": model, "prompt": prompt, "stream": stream}
+  if options:
+    msg["options"] = options
+  if keep_alive not in [None, ""]:
+    msg["keep_alive"] = keep_alive
+  return msg
+
+def cached(args, key):
+  try:
+    if cache(args):
+      res = rd.get(key)
+      if res is not None:
+        return res.decode("utf-8")
+  except Exception as e:
+    print("cache:", e)
+  return None
+
+def store(key, out):
+  try:
+    if rd and len(out) <= CACHE_MAX_SIZE:
+      rd.setex(key, CACHE_TTL, out)
+  except Exception as e:
+    print("cache:", e)
+
+def generate(args, model, prompt, options=None, timeout=None, keep_alive=None):
+  msg = request(model, prompt, options, False, keep_alive)
+  key = cache_key(args, model, prompt, options)
+  res = cached(args, key)
+  if res is not None:
+    return res
+  res = post(args, msg, timeout)
+  if "error" in res:
+    raise RuntimeError(res["error"])
+  out = res.get("response")
+  if out is None:
+    return "No response from model."
+  store(key, out)
+  return out
+
+# streaming mode: the partial output is relayed to the streamer at STREAM_HOST:STREAM_PORT
+# as it arrives, one {"output": ...} json per line, as mastrogpt/chat does
+
+def send(args, outputs):
+  """
+  Send each output to the streamer (if any) as it comes, return the whole output.
+  """
+  sock = None
+  addr = (args.get("STREAM_HOST", ""), int(args.get("STREAM_PORT") or "0"))
+  if addr[0] and addr[1]:
+    sock = socket.create_connection(addr)
+  out = []
+  try:
+    for res in outputs:
+      out.append(res)
+      if sock is not None and res:
+        sock.sendall(json.dumps({"output": res}).encode("utf-8") + b"\n")
+  finally:
+    if sock is not None:
+      sock.close()
+  return "".join(out)
+
+def responses(lines):
+  for line in lines:
+    jo = json.loads(line)
+    if "error" in jo:
+      raise RuntimeError(jo["error"])
+    yield jo.get("response", "")
+
+def relay(args, lines):
+  """
+  Send the output of each line to the streamer (if any), return the whole output.
+  """
+  return send(args, responses(lines))
+
+def generate_stream(args, model, prompt, options=None, timeout=None, keep_alive=None):
+  key = cache_key(args, model, prompt, options)
+  res = cached(args, key)
+  if res is not None:
+    # a cached answer is sent in a single frame
+    return relay(args, [json.dumps({"response": res})])
+  lines = post_lines(args, request(model, prompt, options, True, keep_alive), timeout)
+  out = relay(args, lines)
+  store(key, out)
+  return out
+
+def streaming(args):
+  if str(args.get("stream", "")).lower() in ["1", "true", "yes"]:
+    return True
+  return bool(args.get("STREAM_HOST")) and str(args.get("stream", "")).lower() not in ["0", "false", "no"]
+
+# batch mode: many prompts sent to ollama with at most CONCURRENCY at the same time
+CONCURRENCY = 4
+TIMEOUT = 120
+
+def prompts(args):
+  """
+  The prompts of a batch, from a "batch" list or a "ndjson" text, one json per line.
+  Each prompt is a string or a {"prompt", "model", "options"} object.
+  """
+  items = args.get("batch") or []
+  if args.get("ndjson"):
+    items = []
+    for (n, line) in enumerate(args["ndjson"].splitlines(), 1):
+      if not line.strip():
+        continue
+      try:
+        items.append(json.loads(line))
+      except ValueError as e:
+        raise ValueError(f"Invalid ndjson line {n}: {e}.")
+  for (i, item) in enumerate(items):
+    if not isinstance(item, (str, dict)):
+      raise ValueError(f"Invalid prompt {i}: {item!r}, expected a string or an object.")
+  return [{"prompt": item} if isinstance(item, str) else item for item in items]
+
+def positive(args, key, default, kind=int):
+  value = args.get(key)
+  if value in [None, ""]:
+    return default
+  try:
+    number = kind(value)
+  except (TypeError, ValueError):
+    number = 0
+  if number <= 0:
+    raise ValueError(f"Invalid {key}: {value!r}, expected a positive {'integer' if kind is int else 'number'}.")
+  return number
+
+def limits(args):
+  """
+  The concurrency and the timeout of a batch.
+  """
+  return (positive(args, "concurrency", CONCURRENCY), positive(args, "timeout", TIMEOUT, float))
+
+def batch(args, items):
+  """
+  Yield one result per prompt, in order if "ordered" else as they complete,
+  then a summary with the throughput.
+  """
+  (concurrency, timeout) = limits(args)
+  ordered = str(args.get("ordered", "true")).lower() not in ["0", "false", "no"]
+
+  def one(index, item):
+    start = time.time()
+    res = {"index": index, "prompt": item.get("prompt", "")}
+    try:
+      res["output"] = generate(args, item.get("model", MODEL), res["prompt"], item.get("options"), timeout)
+    except Exception as e:
+      res["error"] = str(e)
+    res["seconds"] = round(time.time() - start, 3)
+    return res
+
+  start = time.time()
+  errors = 0
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    futures = [pool.submit(one, i, item) for (i, item) in enumerate(items)]
+    for future in (futures if ordered else as_completed(futures)):
+      res = future.result()
+      errors += 1 if "error" in res else 0
+      yield res
+  elapsed = time.time() - start
+  yield {
+    "prompts": len(items), "errors": errors, "concurrency": concurrency,
+    "seconds": round(elapsed, 3), "prompts_per_second": round(len(items) / elapsed, 3) if elapsed else 0.0
+  }
+
 def chat(args):
   inp = args.get("input", "")
-  out = f"Welcome to {MODEL}."
-  if inp != "":
-      base = args.get("OLLAMA_URL", os.getenv("OLLAMA_URL"))
-      url = f"{base}/api/generate"
-      msg = {"model": MODEL, "prompt": inp, "stream": False}
-      res = requests.post(url, json=msg, stream=False).json()
-      out = res.get("response", "No response from model.")
-
-  return { "output": out}
+  model = args.get("model") or MODEL
+  out = f"Welcome to {model}."
+  body = {}
+  items = []
+  error = None
+  if inp != "!backends":
+    # an invalid batch is answered, as invalid options
+    try:
+      items = prompts(args)
+      if items:
+        limits(args)
+    except ValueError as e:
+      error = str(e)
+  if inp == "!backends":
+    out = report(args)
+  elif error:
+    out = error
+  elif len(items) > 0:
+      results = (json.dumps(res) + "\n" for res in batch(args, items))
+      if streaming(args):
+        # each result goes to the streamer when it is ready
+        out = send(args, results)
+        body["streaming"] = True
+      else:
+        out = "".join(results)
+      out = out.rstrip("\n")
+  elif inp != "":
+      keep_alive = args.get("keep_alive")
+      try:
+        opts = options(args)
+        if streaming(args):
+          out = generate_stream(args, model, inp, opts, keep_alive=keep_alive)
+          body["streaming"] = True
+        else:
+          out = generate(args, model, inp, opts, keep_alive=keep_alive)
+      except (RuntimeError, ValueError) as e:
+        out = str(e)
+
+  body["output"] = out
+  return body
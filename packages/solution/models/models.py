@@ -1,18 +1,123 @@
-import os, requests
+import os, re, time, requests
+from concurrent.futures import ThreadPoolExecutor
+
+# the model list is cached for TTL seconds in the warm container
+TTL = 60
+cache = {}
+
+# the details of a model never change for the same digest, so they are cached forever
+details_cache = {}
+WORKERS = 4
+TIMEOUT = 30
+
+def invalidate():
+  cache.clear()
+
+def tags(url, ttl=TTL):
+  now = time.time()
+  (expires, models) = cache.get(url, (0.0, []))
+  if now >= expires:
+    models = requests.get(url).json().get("models")
+    cache[url] = (now + ttl, models)
+  return models
+
+def listing(bases, ttl=TTL):
+  """
+  The models of all the backends, each one once, with the first backend having it.
+  """
+  found = {}
+  for base in bases:
+    try:
+      for m in tags(f"{base}/api/tags", ttl):
+        found.setdefault(m.get("name"), (base, m))
+    except requests.RequestException as e:
+      # the other backends can still answer
+      print(f"{base}: {e}")
+      if len(bases) == 1:
+        raise
+  return [found[name] for name in sorted(found)]
+
+# the details of a model that could not be shown
+BLANK = {"parameter_size": "", "quantization": "", "context_length": None}
+
+def show(base, name):
+  data = requests.post(f"{base}/api/show", json={"model": name}, timeout=TIMEOUT).json()
+  if "error" in data:
+    raise RuntimeError(data["error"])
+  details = data.get("details", {})
+  info = data.get("model_info", {})
+  context = next((v for (k, v) in info.items() if k.endswith(".context_length")), None)
+  return {
+    "parameter_size": details.get("parameter_size", ""),
+    "quantization": details.get("quantization_level", ""),
+    "context_length": context
+  }
+
+def lookup(base, name):
+  # a model removed since the listing, or a backend down, leaves its details blank
+  try:
+    return show(base, name)
+  except (requests.RequestException, ValueError, RuntimeError) as e:
+    print(f"{base}: {name}: {e}")
+    return None
+
+def details(models, workers=WORKERS):
+  """
+  The details of the (backend, model) pairs, fetched from /api/show at most workers at a time,
+  only for the digests not seen before. Only the details found of a model with a digest are cached.
+  """
+  missing = [(base, m) for (base, m) in models if m.get("digest") not in details_cache]
+  found = {}
+  if missing:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      infos = pool.map(lambda pair: lookup(pair[0], pair[1].get("name")), missing)
+      for ((base, m), info) in zip(missing, infos):
+        found[m.get("name")] = info
+        if info is not None and m.get("digest"):
+          details_cache[m.get("digest")] = info
+  def info(m):
+    return details_cache.get(m.get("digest")) or found.get(m.get("name")) or BLANK
+  return [dict(info(m), name=m.get("name"), size=m.get("size", 0)) for (_, m) in models]
+
+def parameters(row):
+  # "8.0B" -> 8e9, "270M" -> 2.7e8
+  match = re.match(r"([\d.]+)\s*([KMBT]?)", row["parameter_size"].upper())
+  if not match:
+    return 0.0
+  return float(match.group(1)) * {"": 1, "K": 1e3, "M": 1e6, "B": 1e9, "T": 1e12}[match.group(2)]
+
+def bits(row):
+  # "Q4_K_M" -> 4, "F16" -> 16, unknown last
+  match = re.search(r"(\d+)", row["quantization"])
+  return int(match.group(1)) if match else 99
+
+SORTS = {
+  "name": lambda row: row["name"],
+  "size": lambda row: (parameters(row), row["name"]),
+  "quantization": lambda row: (bits(row), row["name"])
+}
+
+def table(rows, sort="name"):
+  rows = sorted(rows, key=SORTS.get(sort, SORTS["name"]))
+  return "\n".join(f"{r['name']}\t{r['parameter_size']}\t{r['quantization']}\t{r['context_length'] or ''}" for r in rows)
 
 def models(args):
-  
-  # get the url to access ollama models
-  base = args.get("OLLAMA_URL", os.getenv("OLLAMA_URL"))
-  url = f"{base}/api/tags"
+
+  # get the urls to access ollama models, OLLAMA_URL can be a comma separated list
+  value = args.get("OLLAMA_URL", os.getenv("OLLAMA_URL"))
+  bases = [b.strip().rstrip("/") for b in str(value).split(",") if b.strip()]
 
   # list the models
-  models = requests.get(url).json()
-  names = [ i.get("name") for i in models.get("models")]
-  out =  "\n".join(names)
+  if args.get("refresh"):
+    invalidate()
+  if args.get("details") or args.get("sort"):
+    # name, parameters, quantization and context length, sorted by name, size or quantization
+    workers = int(args.get("workers") or WORKERS)
+    out = table(details(listing(bases), workers), args.get("sort", "name"))
+  else:
+    out =  "\n".join(m.get("name") for (_, m) in listing(bases))
 
   # return the output
   return {
     "output": out
   }
-  
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+Benchmark of the mastrogpt/chat relay against the fake ollama server.
+
+For increasing concurrency it runs chat.stream(args, chat.ask(...)) relaying to a
+local stand-in of the streamer, and reports:
+- ttft: time from the streamer connection (or channel, with --mux) to the first output frame
+- tok/s: tokens per second seen by the streamer for each chat
+- relay: cpu time spent relaying one token, measured on pre-encoded lines
+
+    python tests/bench_chat.py --delay 0.1 --rate 100 --tokens 200 --levels 1,4,16,64
+"""
+import os, sys, io, json, time, socket, argparse, threading, statistics
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "packages", "mastrogpt", "chat"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chat
+import fakeollama
+
+class Streamer:
+    """
+    A stand-in for the streamer: it accepts connections and records, for each
+    connection, when it was opened and when the first output frame arrived.
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        self.records = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            (conn, _) = self.sock.accept()
+            threading.Thread(target=self.serve, args=(conn, time.perf_counter()), daemon=True).start()
+
+    def serve(self, conn, opened):
+        # with STREAM_MUX the connection is shared: one record per channel, opened by the state
+        records = {}
+        with conn, conn.makefile("rb") as f:
+            for line in f:
+                msg = json.loads(line)
+                channel = msg.get("channel")
+                if channel not in records:
+                    records[channel] = {"opened": opened if channel is None else time.perf_counter(),
+                                        "first": None, "last": None, "frames": 0, "tokens": 0}
+                    if channel is not None:
+                        conn.sendall(json.dumps({"channel": channel, "ack": True}).encode("utf-8") + b"\n")
+                record = records[channel]
+                record["frames"] += 1
+                if "output" in msg:
+                    record["first"] = record["first"] or time.perf_counter()
+                    record["last"] = time.perf_counter()
+                    record["tokens"] += len(msg["output"].split())
+                if msg.get("done"):
+                    self.add(records.pop(channel))
+        for record in records.values():
+            self.add(record)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def reset(self):
+        with self.lock:
+            (records, self.records) = (self.records, [])
+        return records
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def run(args, concurrency, requests):
+    def one(i):
+        chat.stream(args, chat.ask(args, fakeollama.MODELS[0], f"prompt {i}"), {"state": fakeollama.MODELS[0]})
+    start = time.perf_counter()
+    # the action logs go to stdout, keep them out of the report
+    with redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    return time.perf_counter() - start
+
+def relay_overhead(tokens, repeat=20):
+    # pre-encoded ollama lines, relayed without a streamer: only parsing and framing
+    lines = [json.dumps({"model": "m", "response": f"tok{i} ", "done": False}).encode("utf-8") for i in range(tokens)]
+    start = time.process_time()
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            chat.stream({}, lines)
+    return (time.process_time() - start) / (tokens * repeat)
+
+def main():
+    parser = argparse.ArgumentParser(description="chat streaming benchmark")
+    parser.add_argument("--delay", type=float, default=0.1, help="first token delay in seconds")
+    parser.add_argument("--rate", type=float, default=100.0, help="tokens per second, 0 for unlimited")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per response")
+    parser.add_argument("--levels", default="1,2,4,8,16,32", help="concurrency levels")
+    parser.add_argument("--requests", type=int, default=0, help="requests per level, default 2 x concurrency")
+    parser.add_argument("--framing", default="ndjson")
+    parser.add_argument("--mux", action="store_true", help="share a persistent connection to the streamer")
+    opts = parser.parse_args()
+
+    (server, url) = fakeollama.start(delay=opts.delay, rate=opts.rate, tokens=opts.tokens)
+    streamer = Streamer()
+    args = {
+        "OLLAMA_API_HOST": url,
+        "STREAM_HOST": "127.0.0.1",
+        "STREAM_PORT": streamer.port,
+        "STREAM_FRAMING": opts.framing,
+        "STREAM_MUX": str(opts.mux)
+    }
+
+    print(f"fake ollama: delay={opts.delay}s rate={opts.rate}tok/s tokens={opts.tokens}")
+    print(f"relay overhead: {relay_overhead(opts.tokens) * 1e6:.1f} us/token\n")
+    print(f"{'conc':>5} {'reqs':>5} {'ttft p50':>9} {'ttft p95':>9} {'tok/s p50':>10} {'frames':>7} {'total tok/s':>12}")
+    for level in [int(x) for x in opts.levels.split(",")]:
+        requests = opts.requests or 2 * level
+        elapsed = run(args, level, requests)
+        time.sleep(0.1)
+        records = [r for r in streamer.reset() if r["first"] is not None]
+        ttft = [r["first"] - r["opened"] for r in records]
+        rate = [r["tokens"] / (r["last"] - r["first"]) for r in records if r["last"] > r["first"]]
+        frames = statistics.mean(r["frames"] for r in records) if records else 0
+        tokens = sum(r["tokens"] for r in records)
+        print(f"{level:>5} {len(records):>5} {percentile(ttft, 0.5) * 1000:>7.1f}ms {percentile(ttft, 0.95) * 1000:>7.1f}ms "
+              f"{percentile(rate, 0.5):>10.1f} {frames:>7.1f} {tokens / elapsed:>12.1f}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
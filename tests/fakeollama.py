@@ -0,0 +1,175 @@
+"""
+A stand-in for the Ollama api, to run benchmarks without a live Ollama.
+
+It serves /api/tags, /api/ps, /api/show and /api/generate (streaming and not) with a configurable
+first token delay, token rate and response size, and /api/embed with deterministic
+vectors (the same text always gets the same vector):
+
+    python tests/fakeollama.py --port 11434 --delay 0.2 --rate 50 --tokens 200
+"""
+import json, time, random, hashlib, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MODELS = ["llama3.1:8b", "mistral:7b", "phi4:14b"]
+DIMENSION = 64
+
+def vector(text, dimension=DIMENSION):
+    # words hashed to random directions, so texts sharing words are similar
+    vec = [0.0] * dimension
+    for word in text.lower().split():
+        rnd = random.Random(hashlib.sha256(word.encode("utf-8")).digest())
+        for i in range(dimension):
+            vec[i] += rnd.gauss(0, 1)
+    norm = sum(x * x for x in vec) ** 0.5 or 1.0
+    return [x / norm for x in vec]
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive and chunked responses, as ollama does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, data, status=200):
+        buf = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(buf)))
+        self.end_headers()
+        self.wfile.write(buf)
+
+    def chunk(self, data):
+        buf = json.dumps(data).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(buf):x}\r\n".encode("ascii") + buf + b"\r\n")
+        self.wfile.flush()
+
+    def body(self):
+        size = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(size) or b"{}")
+
+    def do_GET(self):
+        cfg = self.server.config
+        if self.path == "/api/tags":
+            models = [{"name": name, "model": name, "digest": f"{i:064x}", "size": 4_000_000_000}
+                      for (i, name) in enumerate(cfg["models"])]
+            self.reply({"models": models})
+        elif self.path == "/api/ps":
+            self.reply({"models": [{"name": name, "model": name} for name in sorted(cfg["loaded"])]})
+        elif self.path == "/":
+            self.send_response(200)
+            self.send_header("Content-Length", "17")
+            self.end_headers()
+            self.wfile.write(b"Ollama is running")
+        else:
+            self.reply({"error": "not found"}, 404)
+
+    def show(self, model):
+        cfg = self.server.config
+        if model not in cfg["models"]:
+            self.reply({"error": f"model '{model}' not found"}, 404)
+            return
+        cfg["shows"] += 1
+        # "phi4:14b" is a 14.0B model
+        size = model.split(":")[-1].upper()
+        params = f"{float(size[:-1]):.1f}{size[-1]}" if size[:-1].replace(".", "").isdigit() else "7.0B"
+        quant = ["Q4_K_M", "Q8_0", "F16"][cfg["models"].index(model) % 3]
+        family = model.split(":")[0]
+        self.reply({
+            "details": {"family": family, "parameter_size": params, "quantization_level": quant},
+            "model_info": {"general.architecture": family, f"{family}.context_length": 8192 * (1 + cfg["models"].index(model))}
+        })
+
+    def do_POST(self):
+        if self.path == "/api/embed":
+            msg = self.body()
+            inputs = msg.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.reply({"model": msg.get("model", ""), "embeddings": [vector(text) for text in inputs]})
+            return
+        if self.path == "/api/show":
+            self.show(self.body().get("model", ""))
+            return
+        if self.path != "/api/generate":
+            self.reply({"error": "not found"}, 404)
+            return
+        msg = self.body()
+        cfg = self.server.config
+        model = msg.get("model", "")
+        if model not in cfg["models"]:
+            self.reply({"error": f"model '{model}' not found"}, 404)
+            return
+        cfg["loaded"].add(model)
+        if "prompt" not in msg:
+            # just load the model
+            self.reply({"model": model, "response": "", "done": True, "done_reason": "load"})
+            return
+        ntokens = int(msg.get("options", {}).get("num_predict") or cfg["tokens"])
+        if ntokens < 0:
+            ntokens = cfg["tokens"]
+        start = time.time()
+        tokens = (f"tok{i} " for i in range(ntokens))
+        context = list(msg.get("context") or []) + list(range(len(msg.get("prompt", "").split()) + ntokens))
+        final = {
+            "model": model, "done": True, "done_reason": "stop", "context": context,
+            "prompt_eval_count": len(msg.get("prompt", "").split()),
+            "eval_count": ntokens,
+            "load_duration": 0,
+            "prompt_eval_duration": int(cfg["delay"] * 1e9),
+        }
+
+        def pace(i):
+            # sleep up to the scheduled time of the i-th token
+            due = start + cfg["delay"] + (i / cfg["rate"] if cfg["rate"] > 0 else 0)
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+        if msg.get("stream", True) is False:
+            pace(ntokens)
+            final["response"] = "".join(tokens)
+            final["eval_duration"] = int((time.time() - start - cfg["delay"]) * 1e9)
+            final["total_duration"] = int((time.time() - start) * 1e9)
+            self.reply(final)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for (i, token) in enumerate(tokens):
+                pace(i)
+                self.chunk({"model": model, "response": token, "done": False})
+            final["response"] = ""
+            final["eval_duration"] = int((time.time() - start - cfg["delay"]) * 1e9)
+            final["total_duration"] = int((time.time() - start) * 1e9)
+            self.chunk(final)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, as when a generation is cancelled
+            self.close_connection = True
+
+def start(port=0, delay=0.1, rate=50.0, tokens=100, models=MODELS):
+    """
+    Start the server in a background thread, return (server, url).
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.config = {"delay": delay, "rate": rate, "tokens": tokens, "models": list(models), "loaded": set(), "shows": 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, f"http://127.0.0.1:{server.server_address[1]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fake ollama server")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--delay", type=float, default=0.1, help="first token delay in seconds")
+    parser.add_argument("--rate", type=float, default=50.0, help="tokens per second, 0 for unlimited")
+    parser.add_argument("--tokens", type=int, default=100, help="tokens per response")
+    parser.add_argument("--models", default=",".join(MODELS))
+    opts = parser.parse_args()
+    (server, url) = start(opts.port, opts.delay, opts.rate, opts.tokens, opts.models.split(","))
+    print(f"fake ollama on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,40 @@
+import os, sys
+import pytest
+import fakeollama
+
+# the mastrogpt actions import their modules top level, as they are deployed
+ROOT = os.path.join(os.path.dirname(__file__), "..", "..", "packages", "mastrogpt")
+sys.path.insert(0, os.path.abspath(os.path.join(ROOT, "chat")))
+sys.path.insert(0, os.path.abspath(os.path.join(ROOT, "metrics")))
+
+@pytest.fixture(scope="session", autouse=True)
+def set_env():
+    # these tests run against fakeollama, no login needed
+    pass
+
+@pytest.fixture(scope="session")
+def ollama():
+    (server, url) = fakeollama.start(delay=0.01, rate=0, tokens=20)
+    yield url
+    server.shutdown()
+
+@pytest.fixture
+def args(ollama):
+    import balancer, catalog, residency
+    # the warm container state of one test does not leak into the next
+    balancer.backends.clear()
+    balancer.checked = 0.0
+    catalog.invalidate()
+    residency.invalidate()
+    return {"OLLAMA_API_HOST": ollama, "CHAT_ADMISSION": "false"}
+
+@pytest.fixture
+def redis(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    # the lua scripts need lupa
+    pytest.importorskip("lupa")
+    import rdb
+    rd = fakeredis.FakeRedis()
+    monkeypatch.setattr(rdb, "rd", rd)
+    monkeypatch.setattr(rdb, "prefix", "test:")
+    return rd
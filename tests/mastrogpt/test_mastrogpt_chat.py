@@ -0,0 +1,253 @@
+import os, sys, json, time, struct, socket, asyncio, threading
+import balancer, catalog, chat, sessions, mux, residency
+import fakeollama
+from writer import FrameWriter
+
+class Sock:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def sendall(self, buf):
+        self.sent.append(buf)
+
+    def close(self):
+        self.closed = True
+
+def tokens(n):
+    return [json.dumps({"response": f"t{i} ", "done": False}).encode("utf-8") for i in range(n)]
+
+def test_writer_framing():
+    sock = Sock()
+    writer = FrameWriter(sock, "ndjson", max_delay=60)
+    writer.write({"output": "a"})
+    writer.write({"output": "b"})
+    writer.write({"output": "c"})
+    writer.write({"state": "m"})
+    writer.close()
+    # the first token goes at once, then pending output is merged and goes before the state
+    assert b"".join(sock.sent) == b'{"output": "a"}\n{"output": "bc"}\n{"state": "m"}\n'
+    assert sock.closed
+
+    sock = Sock()
+    writer = FrameWriter(sock, "length")
+    writer.send({"output": "abc"})
+    (size,) = struct.unpack(">I", sock.sent[0][:4])
+    assert json.loads(sock.sent[0][4:4 + size]) == {"output": "abc"}
+
+    # raw json cannot be split on a shared connection
+    sock = Sock()
+    writer = FrameWriter(sock, "raw", channel="c1")
+    writer.send({"output": "x"})
+    assert json.loads(sock.sent[0]) == {"output": "x", "channel": "c1"}
+    assert sock.sent[0].endswith(b"\n")
+
+def test_writer_flush():
+    sock = Sock()
+    writer = FrameWriter(sock, "ndjson", max_bytes=4, max_delay=60)
+    writer.write({"output": "a"})
+    writer.write({"output": "bc"})
+    assert len(sock.sent) == 1
+    writer.write({"output": "de"})
+    assert sock.sent[1:] == [b'{"output": "bcde"}\n']
+
+    # in a loop, pending output is flushed by a timer without waiting for the next token
+    async def slow():
+        sock = Sock()
+        writer = FrameWriter(sock, "ndjson", max_delay=0.02)
+        writer.write({"output": "a"})
+        writer.write({"output": "b"})
+        await asyncio.sleep(0.1)
+        return sock.sent
+    assert asyncio.run(slow()) == [b'{"output": "a"}\n', b'{"output": "b"}\n']
+
+def test_catalog_matches():
+    names = sorted(["llama3.1:8b", "llama3.2:3b", "mistral:7b", "phi4:14b"])
+    assert catalog.matches(names, "llama") == ["llama3.1:8b", "llama3.2:3b"]
+    assert catalog.matches(names, "phi4:14b") == ["phi4:14b"]
+    assert catalog.matches(names, "qwen") == []
+    assert catalog.select(names, "m") == "mistral:7b"
+    assert catalog.select(names, "x") is None
+
+def test_sessions_pack():
+    context = [0, 1, 128000, 2**31 - 1, -1] + list(range(1000))
+    data = sessions.pack(context)
+    assert sessions.unpack(data) == context
+    assert len(data) < len(context) * 4
+    assert sessions.split("llama3.1:8b#abc") == ("llama3.1:8b", "abc")
+    assert sessions.join("llama3.1:8b", "") == "llama3.1:8b"
+
+def test_balancer_failover(args, ollama):
+    dead = "http://127.0.0.1:1"
+    args["OLLAMA_API_HOST"] = f"{dead},{ollama}"
+    # not probed yet: both look healthy and the first one is tried first
+    balancer.checked = time.time()
+    lines = balancer.Lines(args, "generate", None, json={"model": "llama3.1:8b", "prompt": "hi"})
+    out = [json.loads(line) for line in lines]
+    assert out[-1]["done"]
+    assert balancer.backend(dead)["errors"] == 1
+    assert not balancer.backend(dead)["healthy"]
+    assert balancer.backend(ollama)["inflight"] == 0
+    # then the failed backend is avoided
+    assert balancer.choose(args) == ollama
+
+def test_guard_tokens():
+    out = chat.stream({"CHAT_MAX_TOKENS": "3"}, tokens(10))
+    assert out == "t0 t1 t2 \n[stopped: token budget]\n"
+
+def test_guard_time():
+    def slow():
+        for line in tokens(100):
+            time.sleep(0.05)
+            yield line
+    start = time.time()
+    out = chat.stream({"CHAT_MAX_TIME": "0.5"}, slow())
+    assert out.endswith("[stopped: time limit]\n")
+    assert time.time() - start < 2
+
+def test_first_token_timeout(args):
+    (server, url) = fakeollama.start(delay=3, rate=0, tokens=1)
+    args.update({"OLLAMA_API_HOST": url, "OLLAMA_FIRST_TOKEN_TIMEOUT": "0.2", "state": "llama3.1:8b", "input": "hi"})
+    start = time.time()
+    res = chat.chat(args)
+    assert res["output"] == "Error: no line from the upstream in 0.2s\n"
+    # the blocked read does not hold the action
+    assert time.time() - start < 1
+    server.shutdown()
+
+def test_upstream_errors(args):
+    args.update({"state": "nope:1b", "input": "hi"})
+    assert chat.chat(args)["output"] == "Error: model 'nope:1b' not found\n"
+    args.update({"OLLAMA_API_HOST": "http://127.0.0.1:1", "state": "llama3.1:8b"})
+    assert chat.chat(args)["output"].startswith("Error: ")
+
+def test_chat(args, monkeypatch):
+    monkeypatch.delitem(sys.modules, "semcache", raising=False)
+    args.update({"state": "llama3.1:8b", "input": "hello"})
+    res = chat.chat(args)
+    assert res["output"] == "".join(f"tok{i} " for i in range(20))
+    # pymilvus is loaded only with the semantic cache
+    assert "semcache" not in sys.modules
+
+    args.update({"state": "", "input": "@mis"})
+    res = chat.chat(args)
+    assert res["output"].find("mistral:7b") != -1
+
+def test_shared_copies():
+    # actions are deployed as separate zips, so a module used by two of them is copied: keep the copies equal
+    root = os.path.join(os.path.dirname(__file__), "..", "..", "packages", "mastrogpt")
+    for (name, actions) in [("vdb.py", ["loader", "chat"]), ("embeddings.py", ["embed", "loader", "chat"])]:
+        copies = [open(os.path.join(root, action, name), "rb").read() for action in actions]
+        assert all(copy == copies[0] for copy in copies), f"{name} differs in {actions}"
+
+class Streamer:
+    """
+    A streamer speaking the mux protocol: it acks the states, and closes a channel after close_after outputs.
+    """
+    def __init__(self, close_after=0):
+        self.close_after = close_after
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.addr = self.sock.getsockname()
+        self.frames = []
+        self.conns = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            (conn, _) = self.sock.accept()
+            self.conns.append(conn)
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        outputs = {}
+        try:
+            with conn.makefile("rb") as lines:
+                for line in lines:
+                    msg = json.loads(line)
+                    self.frames.append(msg)
+                    channel = msg["channel"]
+                    if channel not in outputs:
+                        outputs[channel] = 0
+                        conn.sendall(json.dumps({"channel": channel, "ack": True}).encode("utf-8") + b"\n")
+                    if "output" in msg:
+                        outputs[channel] += 1
+                        if outputs[channel] == self.close_after:
+                            conn.sendall(json.dumps({"channel": channel, "close": True}).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+def test_mux_ack(monkeypatch):
+    monkeypatch.setattr(mux, "connections", {})
+    streamer = Streamer()
+    channel = mux.Channel(streamer.addr, 1)
+    channel.sendall(json.dumps({"channel": channel.id, "state": "m"}).encode("utf-8") + b"\n")
+    assert channel.acked.wait(1)
+    channel.close()
+    # the channels share the connection
+    other = mux.Channel(streamer.addr, 1)
+    assert other.conn is channel.conn
+    assert not channel.closed.is_set()
+    time.sleep(0.1)
+    assert streamer.frames[-1] == {"channel": channel.id, "done": True}
+
+def test_mux_close(monkeypatch):
+    monkeypatch.setattr(mux, "connections", {})
+    streamer = Streamer(close_after=3)
+    args = {"STREAM_HOST": streamer.addr[0], "STREAM_PORT": str(streamer.addr[1]), "STREAM_MUX": "true"}
+    def slow():
+        for line in tokens(100):
+            time.sleep(0.01)
+            yield line
+    # the client of the channel went away: the relay stops
+    out = chat.stream(args, slow(), {"state": "m"})
+    assert out.endswith("[stopped: client disconnected]\n")
+    assert out.count("t") < 100
+
+def test_mux_reconnect(monkeypatch):
+    monkeypatch.setattr(mux, "connections", {})
+    streamer = Streamer()
+    channel = mux.Channel(streamer.addr, 1)
+    broken = channel.conn
+    # the pooled connection broke while idle: nothing was sent, so a new one is used
+    broken.sock.shutdown(socket.SHUT_WR)
+    channel.sendall(json.dumps({"channel": channel.id, "state": "m"}).encode("utf-8") + b"\n")
+    assert channel.acked.wait(1)
+    assert channel.conn is not broken and not broken.alive
+    assert len(streamer.conns) == 2
+    assert mux.connect(streamer.addr, 1) is channel.conn
+
+def test_residency_prefer():
+    assert residency.prefer(["llama3.1:8b", "llama3.2:3b"], {"llama3.2:3b"}) == "llama3.2:3b"
+    assert residency.prefer(["llama3.1:8b", "llama3.2:3b"], set()) == "llama3.1:8b"
+    assert residency.prefer([], {"llama3.2:3b"}) is None
+
+def test_residency_keep_alive():
+    args = {"OLLAMA_HOT_MODELS": "phi4:14b, mistral:7b"}
+    assert residency.keep_alive(args, "phi4:14b") == -1
+    assert residency.keep_alive(args, "llama3.1:8b") == residency.KEEP_ALIVE
+    args["OLLAMA_KEEP_ALIVE"] = "1h"
+    assert residency.keep_alive(args, "llama3.1:8b") == "1h"
+
+def test_residency_chat(args, monkeypatch):
+    (server, url) = fakeollama.start(models=["llama3.1:8b", "llama3.2:3b", "mistral:7b"])
+    server.config["loaded"].add("llama3.2:3b")
+    args["OLLAMA_API_HOST"] = url
+    # the loaded models are marked
+    args["input"] = "@"
+    out = chat.chat(args)["output"]
+    assert "* llama3.2:3b\n" in out and "  llama3.1:8b\n" in out
+
+    # the loaded match is preferred, the catalog is read once
+    loads = []
+    load = catalog.load
+    monkeypatch.setattr(catalog, "load", lambda *a: loads.append(1) or load(*a))
+    args["input"] = "@llama"
+    assert chat.chat(args)["output"] == "selected llama3.2:3b\n"
+    assert len(loads) == 1
+
+    # the selected model is preloaded, the hot ones pinned
+    residency.invalidate()
+    args.update({"input": "@mis", "OLLAMA_HOT_MODELS": "llama3.1:8b"})
+    assert chat.chat(args)["output"] == "selected mistral:7b\n"
+    assert server.config["loaded"] == {"llama3.1:8b", "llama3.2:3b", "mistral:7b"}
+    server.shutdown()
@@ -0,0 +1,338 @@
+import json, time, random, threading
+import pytest
+import admission, singleflight, guard, chat, respcache, sessions, router
+
+def slow(n, delay):
+    for i in range(n):
+        time.sleep(delay)
+        yield f"t{i}"
+
+def test_singleflight_renew(redis, monkeypatch):
+    monkeypatch.setattr(singleflight, "LOCK_TTL", 0.3)
+    (lock, name) = singleflight.names("test:", "k")
+    redis.set(lock, "me", px=300)
+    leader = singleflight.Leader(redis, lock, name, "me", slow(6, 0.1))
+    lines = iter(leader)
+    for _ in range(5):
+        next(lines)
+    # renewed past its first expiry
+    assert redis.get(lock) == b"me"
+    list(lines)
+    assert redis.get(lock) is None
+    assert redis.xrange(name)[-1][1] == {b"end": b"done"}
+
+def test_singleflight_lost(redis, monkeypatch):
+    monkeypatch.setattr(singleflight, "LOCK_TTL", 0.3)
+    (lock, name) = singleflight.names("test:", "k")
+    redis.set(lock, "me", px=300)
+    leader = singleflight.Leader(redis, lock, name, "me", slow(6, 0.1))
+    lines = iter(leader)
+    next(lines)
+    # another leader took over
+    redis.set(lock, "other")
+    assert list(lines) == [b"t1", b"t2", b"t3", b"t4", b"t5"]
+    # the stream stops where the lock was lost, without an end, and the lock stays to the new owner
+    published = [fields.get(b"line") for (_, fields) in redis.xrange(name)]
+    assert b"t5" not in published
+    assert all(line is not None for line in published)
+    assert redis.get(lock) == b"other"
+
+def test_singleflight_drain(redis):
+    (lock, name) = singleflight.names("test:", "k")
+    redis.set(lock, "me", ex=singleflight.LOCK_TTL)
+    redis.set(singleflight.followers(name), 1)
+    leader = singleflight.Leader(redis, lock, name, "me", slow(5, 0.01))
+    lines = iter(leader)
+    assert next(lines) == b"t0"
+    # the client of the leader goes away: the generation goes on for the follower
+    leader.close()
+    lines.close()
+    follower = singleflight.Follower(redis, lock, name, lambda: ["own"])
+    assert list(follower) == [b"t0", b"t1", b"t2", b"t3", b"t4"]
+    assert redis.get(lock) is None
+    # drained before the activation ends
+    assert singleflight.draining == [leader]
+    singleflight.join({})
+    assert singleflight.draining == []
+
+class Upstream:
+    def __init__(self):
+        self.closed = False
+
+    def __iter__(self):
+        while True:
+            time.sleep(0.01)
+            if self.closed:
+                raise ConnectionError("closed")
+            yield b"t"
+
+    def close(self):
+        self.closed = True
+
+def test_singleflight_drain_timeout(redis):
+    (lock, name) = singleflight.names("test:", "k")
+    redis.set(lock, "me", ex=singleflight.LOCK_TTL)
+    redis.set(singleflight.followers(name), 1)
+    leader = singleflight.Leader(redis, lock, name, "me", Upstream())
+    lines = iter(leader)
+    next(lines)
+    leader.close()
+    threading.Thread(target=lines.close, daemon=True).start()
+    start = time.time()
+    singleflight.join({"CHAT_SINGLEFLIGHT_DRAIN": "0.2"})
+    assert time.time() - start < 1
+    # the upstream is closed and the followers are told
+    assert redis.xrange(name)[-1][1] == {b"end": b"error"}
+    assert redis.get(lock) is None
+
+def test_singleflight_alone(redis):
+    (lock, name) = singleflight.names("test:", "k")
+    redis.set(lock, "me", ex=singleflight.LOCK_TTL)
+    upstream = slow(5, 0.01)
+    leader = singleflight.Leader(redis, lock, name, "me", upstream)
+    lines = iter(leader)
+    next(lines)
+    leader.close()
+    lines.close()
+    # nobody follows: the generation stops
+    assert redis.xrange(name)[-1][1] == {b"end": b"error"}
+    assert list(upstream) == []
+
+def test_admission_user(redis):
+    redis.set("test:TOKEN:alice", "s3cret")
+    assert admission.user({"token": "alice:s3cret"}, "sess") == "alice"
+    # a token not matching the login is not trusted
+    assert admission.user({"token": "alice:guess"}, "sess") == "sess"
+    assert admission.user({"token": "bob:s3cret"}, "sess") == "sess"
+    assert admission.user({}, "") == "anonymous"
+
+def acquire(rd, user, ticket, opts):
+    keys = admission.names("test:", user)
+    return rd.eval(admission.ACQUIRE, len(keys), *keys, ticket, time.time(), opts["lease"],
+                   opts["running"], opts["user"], opts["queue"], admission.STALE)
+
+def test_admission_fair(redis):
+    opts = admission.options({"CHAT_MAX_RUNNING": "1", "CHAT_USER_CONCURRENCY": "3", "CHAT_QUEUE_SIZE": "3"})
+    assert acquire(redis, "carol", "c1", opts) == admission.RUNNING
+    # a burst of alice does not go before bob
+    assert acquire(redis, "alice", "a1", opts) == 1
+    assert acquire(redis, "alice", "a2", opts) == 2
+    assert acquire(redis, "bob", "b1", opts) == 2
+    assert acquire(redis, "alice", "a2", opts) == 3
+    assert acquire(redis, "dave", "d1", opts) == admission.QUEUE_FULL
+    # the slot is freed: the head of the queue runs, the others wait
+    admission.release({}, "carol", "c1", 0, 1.0)
+    assert acquire(redis, "bob", "b1", opts) == 2
+    assert acquire(redis, "alice", "a1", opts) == admission.RUNNING
+    assert acquire(redis, "bob", "b1", opts) == 1
+
+def test_admission_user_limit(redis):
+    args = {"CHAT_USER_CONCURRENCY": "2"}
+    (first, _) = admission.admit(args, "alice")
+    (second, _) = admission.admit(args, "alice")
+    assert first and second
+    (third, refused) = admission.admit(args, "alice")
+    assert third is None and refused.startswith("Busy, retry in")
+    # other users are not affected
+    assert admission.admit(args, "bob")[0]
+    admission.release(args, "alice", first, 10, 1.0)
+    assert admission.admit(args, "alice")[0]
+
+def test_admission_tokens(redis):
+    args = {"CHAT_USER_TOKENS_PER_MIN": "60"}
+    (ticket, _) = admission.admit(args, "alice")
+    lines = admission.Admitted(args, "alice", ticket, [f"t{i}" for i in range(100)])
+    assert len(list(lines)) == 100
+    # the budget of a minute is spent: refused until refilled at 1 token per second
+    (ticket, refused) = admission.admit(args, "alice")
+    assert ticket is None and refused.startswith("Busy, retry in 4")
+
+def test_stop_running(redis):
+    args = {}
+    lines = guard.Running(args, "s1", slow(3, 0.01))
+    assert not guard.abort(args, "s1")
+    it = iter(lines)
+    next(it)
+    assert guard.abort(args, "s1")
+    assert guard.Guard(args, "s1").aborted()
+    list(it)
+    # an abort after the end is not kept
+    assert not guard.abort(args, "s1")
+    assert not redis.exists("test:ABORT:s1")
+
+def test_stop_idle(args, redis):
+    # nothing running: the next prompt of the session is not stopped
+    args.update({"state": "llama3.1:8b#s1", "input": "!stop"})
+    assert chat.chat(args)["output"] == "Nothing to stop.\n"
+    args["input"] = "tell me more"
+    assert chat.chat(args)["output"] == "".join(f"tok{i} " for i in range(20))
+
+def test_admission_lease():
+    assert admission.options({"CHAT_MAX_TIME": "0"})["lease"] == admission.LEASE
+    assert admission.options({"CHAT_MAX_TIME": "30"})["lease"] == 30
+
+def test_admission_cached(args, redis):
+    args.update({"CHAT_ADMISSION": "true", "CHAT_MAX_RUNNING": "1", "CHAT_QUEUE_WAIT": "0", "state": "llama3.1:8b"})
+    # the only slot is taken
+    assert admission.admit(args, "other")[0]
+    respcache.put(args, "llama3.1:8b", "cached", chat.options(args), "from the cache")
+    args["input"] = "cached"
+    assert chat.chat(args)["output"] == "from the cache"
+    args["input"] = "not cached"
+    assert chat.chat(args)["output"].startswith("Busy, retry in")
+
+def test_respcache(redis):
+    args = {}
+    assert respcache.get(args, "m", "hi", {}) is None
+    respcache.put(args, "m", "hi", {"seed": 1}, "hello", [1, 2, 3])
+    assert respcache.get(args, "m", "hi", {"seed": 1}) == ("hello", [1, 2, 3])
+    # other options are another entry
+    assert respcache.get(args, "m", "hi", {"seed": 2}) is None
+    # too big to be cached
+    respcache.put({"CHAT_CACHE_MAX_SIZE": "4"}, "m", "big", {}, "hello")
+    assert respcache.get(args, "m", "big", {}) is None
+
+def test_respcache_evict(redis):
+    args = {"CHAT_CACHE_MAX_ENTRIES": "2"}
+    for i in range(3):
+        respcache.put(args, "m", f"p{i}", {}, f"a{i}", [i])
+        time.sleep(0.01)
+    # the oldest is forgotten, with its context
+    assert respcache.get(args, "m", "p0", {}) is None
+    assert [respcache.get(args, "m", f"p{i}", {}) for i in [1, 2]] == [("a1", [1]), ("a2", [2])]
+    assert redis.zcard("test:CHAT:index") == 2
+    assert not redis.exists(f"test:CHAT:{respcache.key('m', 'p0', {})}:ctx")
+
+def test_respcache_cached(redis):
+    args = {}
+    lines = [json.dumps({"response": "a", "done": False}).encode(), json.dumps({"response": "b", "done": True, "context": [7]}).encode()]
+    first = respcache.cached(args, "m", "hi", {}, lambda: iter(lines))
+    assert list(first) == lines
+    # a hit replays the whole answer and its context, to go on with the session
+    hit = respcache.cached(args, "m", "hi", {}, lambda: 1 / 0)
+    assert [json.loads(line) for line in hit] == [{"response": "ab", "done": True, "context": [7]}]
+
+def test_sessions(redis):
+    args = {}
+    assert sessions.load(args, "s1") is None
+    sessions.save(args, "s1", [1, 2, 3])
+    assert sessions.load(args, "s1") == [1, 2, 3]
+    # a conversation too long starts again from scratch
+    sessions.save({"CHAT_SESSION_MAX_TOKENS": "2"}, "s1", [1, 2, 3])
+    assert sessions.load(args, "s1") is None
+
+def test_sessions_evict(redis):
+    args = {"CHAT_SESSION_MAX": "2"}
+    for i in range(3):
+        sessions.save(args, f"s{i}", [i])
+        time.sleep(0.01)
+    assert [sessions.load(args, f"s{i}") for i in range(3)] == [None, [1], [2]]
+    assert redis.zcard("test:CTX:index") == 2
+
+def test_sessions_recorder(redis):
+    args = {}
+    lines = [json.dumps({"response": "a", "done": False, "context": [9]}).encode(),
+             json.dumps({"response": "", "done": True, "context": [4, 5, 6]}).encode()]
+    assert list(sessions.Recorder(args, "s1", lines)) == lines
+    # the context of the final chunk
+    assert sessions.load(args, "s1") == [4, 5, 6]
+
+class Cache:
+    # a SemanticCache without milvus: the nearest prompt is at the given similarity
+    def __init__(self, score):
+        self.score = score
+        self.stored = {}
+
+    def lookup(self, model, options, vector):
+        if (model, options) not in self.stored:
+            return (0.0, None)
+        return (self.score, self.stored[(model, options)])
+
+    def store(self, id, model, options, prompt, answer, vector, ttl):
+        self.stored[(model, options)] = answer
+
+    def purge(self):
+        pass
+
+def test_semcache_worth(monkeypatch):
+    semcache = pytest.importorskip("semcache")
+    assert semcache.worth({"lookups": 10, "generations": 10, "generate_ms": 1000})
+    # hits save more than the lookups cost
+    data = {"lookups": 100, "hits": 50, "lookup_ms": 1000, "generations": 50, "generate_ms": 50000}
+    assert semcache.worth(data)
+    # no hits: only a sample is looked up
+    data["hits"] = 0
+    monkeypatch.setattr(random, "random", lambda: 0.5)
+    assert not semcache.worth(data)
+    monkeypatch.setattr(random, "random", lambda: 0.05)
+    assert semcache.worth(data)
+
+def test_semcache_cached(redis, monkeypatch):
+    semcache = pytest.importorskip("semcache")
+    cache = Cache(0.95)
+    monkeypatch.setattr(semcache, "connect", lambda args, collection, dimension: cache)
+    monkeypatch.setattr(semcache, "embed", lambda args, model, text: [1.0, 0.0])
+    args = {"CHAT_SEMANTIC_CACHE": "true", "MILVUS_HOST": "milvus"}
+    lines = [json.dumps({"response": "rome", "done": True}).encode()]
+    generated = []
+    def generate():
+        generated.append(1)
+        return iter(lines)
+
+    # a miss records the answer with the hash of the options
+    assert list(semcache.cached(args, "m", "capital of italy?", {"seed": 1}, generate)) == lines
+    assert cache.stored == {("m", semcache.options_hash({"seed": 1})): "rome"}
+    # a similar prompt above the threshold is answered from the cache
+    out = list(semcache.cached(args, "m", "the capital of italy?", {"seed": 1}, generate))
+    assert [json.loads(line) for line in out] == [{"response": "rome", "done": True}]
+    assert len(generated) == 1
+    # other options, or below the threshold, are misses
+    list(semcache.cached(args, "m", "the capital of italy?", {"seed": 2}, generate))
+    assert len(generated) == 2
+    cache.score = 0.9
+    list(semcache.cached(args, "m", "the capital of italy?", {"seed": 1}, generate))
+    assert len(generated) == 3
+    assert semcache.stats(args)["hits"] == 1 and semcache.stats(args)["misses"] == 3
+
+def test_router_state():
+    assert router.active("auto") and router.active("auto=phi4:14b")
+    assert not router.active("llama3.1:8b")
+    assert router.chosen("auto=phi4:14b") == "phi4:14b"
+    assert router.chosen("auto") == ""
+    assert router.state("phi4:14b") == "auto=phi4:14b"
+
+def test_router_route(redis):
+    args = {"CHAT_ROUTER_TIERS": "small, medium, large", "CHAT_ROUTER_LIMITS": "100,1000"}
+    assert router.route({}, "hi", {}) == (None, "no CHAT_ROUTER_TIERS")
+    # unmeasured: the smallest tier big enough
+    assert router.route(args, "hi", {"num_predict": 10})[0] == "small"
+    assert router.route(args, "hi", {"num_predict": 500})[0] == "medium"
+    assert router.route(args, "x" * 8000, {})[0] == "large"
+    # measured faster and idle, the bigger tier wins
+    for (model, tps) in [("small", 10), ("medium", 100)]:
+        redis.hset(f"test:METRICS:{model}:tps", mapping={"count": 1, "sum": tps})
+        redis.hset(f"test:METRICS:{model}:ttft_ms", mapping={"count": 1, "sum": 100})
+    args["CHAT_ROUTER_TIERS"] = "small,medium"
+    (model, reason) = router.route(args, "hi", {"num_predict": 50})
+    assert model == "medium" and "tps=100 inflight=0" in reason
+    # busy, it loses to the slower one
+    redis.set("test:ROUTER:inflight:medium", 20)
+    assert router.route(args, "hi", {"num_predict": 50})[0] == "small"
+
+def test_router_running(redis):
+    lines = router.Running({}, "small", iter(["a", "b"]))
+    it = iter(lines)
+    next(it)
+    assert redis.get("test:ROUTER:inflight:small") == b"1"
+    list(it)
+    assert redis.get("test:ROUTER:inflight:small") == b"0"
+
+def test_router_chat(args, redis):
+    args.update({"CHAT_ROUTER_TIERS": "phi4:14b,mistral:7b", "state": "auto", "input": "hi"})
+    assert chat.chat(args)["output"] == "".join(f"tok{i} " for i in range(20))
+    # the smallest tier, measured by the meter
+    assert redis.smembers("test:METRICS:models") == {b"phi4:14b"}
+    # a conversation stays on the model chosen
+    args["state"] = "auto=mistral:7b#s1"
+    chat.chat(args)
+    assert redis.smembers("test:METRICS:models") == {b"phi4:14b", b"mistral:7b"}
@@ -0,0 +1,44 @@
+import embeddings
+import fakeollama
+
+def test_text_id():
+    assert embeddings.text_id("hello") == embeddings.text_id("hello")
+    assert embeddings.text_id("hello") != embeddings.text_id("hello!")
+    assert -2**63 <= embeddings.text_id("hello") < 2**63
+
+def test_pack():
+    vector = [0.5, -1.0, 0.25]
+    assert embeddings.unpack(embeddings.pack(vector)).tolist() == vector
+
+def test_vectors(args, redis, monkeypatch):
+    monkeypatch.setattr(embeddings, "memory", {})
+    monkeypatch.setattr(embeddings, "rd", redis)
+    monkeypatch.setattr(embeddings, "prefix", "test:")
+    fetched = []
+    fetch = embeddings.fetch
+    def counted(args, model, texts, host=None):
+        fetched.append(list(texts))
+        return fetch(args, model, texts, host)
+    monkeypatch.setattr(embeddings, "fetch", counted)
+    args["OLLAMA_EMBED_BATCH"] = "2"
+
+    texts = ["a b", "c d", "a b", "e f", "g h"]
+    (bufs, hits) = embeddings.vectors(args, "nomic-embed-text", texts)
+    assert hits == 0
+    # each distinct text is embedded once
+    assert fetched == [["a b", "c d", "e f", "g h"]]
+    out = [embeddings.unpack(buf).tolist() for buf in bufs]
+    assert out[0] == out[2]
+    assert [round(x, 5) for x in out[1]] == [round(x, 5) for x in fakeollama.vector("c d")]
+    assert redis.exists(f"test:EMBED:nomic-embed-text:{embeddings.text_id('e f')}")
+
+    # then from the warm container
+    (again, hits) = embeddings.vectors(args, "nomic-embed-text", texts)
+    assert (again, hits) == (bufs, 5)
+
+    # and from redis in a new container
+    embeddings.memory.clear()
+    (again, hits) = embeddings.vectors(args, "nomic-embed-text", ["g h", "i j"])
+    assert hits == 1
+    assert again[0] == bufs[4]
+    assert fetched[-1] == ["i j"]
@@ -0,0 +1,78 @@
+import pytest
+
+vdb = pytest.importorskip("vdb", reason="needs pymilvus")
+
+def test_chunks():
+    words = [f"word{i}" for i in range(1000)]
+    text = " ".join(words)
+    chunks = vdb.chunks(text, size=200, overlap=40)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert all(chunk in text for chunk in chunks)
+    # cut at whitespace: a chunk ends with a whole word
+    assert all(chunk.split()[-1] in words for chunk in chunks)
+    # every word is in a chunk, and consecutive chunks overlap
+    assert set(words) <= set(word for chunk in chunks for word in chunk.split())
+    for (prev, next) in zip(chunks, chunks[1:]):
+        assert prev.split()[-1] in next.split()
+    assert vdb.chunks("  short  ") == ["short"]
+    assert vdb.chunks("") == []
+    # an overlap as long as the chunk does not move one character at a time
+    text = " ".join(words * 20)
+    assert len(vdb.chunks(text, size=200, overlap=200)) <= 3 * len(text) / 200
+    assert len(vdb.chunks(text, size=0, overlap=0)) <= len(text)
+
+def test_chunks_bytes():
+    # multibyte characters: a chunk never exceeds DIMENSION_TEXT bytes
+    text = "è" * (vdb.DIMENSION_TEXT * 2)
+    chunks = vdb.chunks(text, size=vdb.DIMENSION_TEXT, overlap=10)
+    assert all(len(chunk.encode("utf-8")) <= vdb.DIMENSION_TEXT for chunk in chunks)
+    assert sum(len(chunk) for chunk in chunks) >= len(text)
+
+def test_like():
+    assert vdb.like("milvus") == 'text like "%milvus%"'
+    # the wildcards are escaped for like, then the backslashes for the string literal
+    assert vdb.like("100%") == r'text like "%100\\%%"'
+    assert vdb.like("a_b") == r'text like "%a\\_b%"'
+    assert vdb.like('say "hi"') == r'text like "%say \"hi\"%"'
+
+class Client:
+    def __init__(self, collections):
+        self.existing = list(collections)
+        self.lists = 0
+        self.stats = 0
+
+    def list_collections(self):
+        self.lists += 1
+        return list(self.existing)
+
+    def get_collection_stats(self, collection):
+        self.stats += 1
+        return {"row_count": 10 * self.stats}
+
+def test_collections_ttl(monkeypatch):
+    client = Client(["default"])
+    monkeypatch.setattr(vdb, "connect", lambda args: ("key", client))
+    monkeypatch.setattr(vdb, "names", {})
+    db = vdb.VectorDB({}, "default")
+    assert db.collections() == ["default"]
+    assert client.lists == 1
+    # created by another container: seen when the list expires
+    client.existing.append("other")
+    assert db.collections() == ["default"]
+    vdb.names["key"] = (0.0, vdb.names["key"][1])
+    assert db.collections() == ["default", "other"]
+    assert client.lists == 2
+
+def test_count_ttl(monkeypatch):
+    client = Client(["default"])
+    monkeypatch.setattr(vdb, "connect", lambda args: ("key", client))
+    monkeypatch.setattr(vdb, "counts", {})
+    db = vdb.VectorDB({}, "default")
+    assert db.count() == "10"
+    (expires, _) = vdb.counts[("key", "default")]
+    # a cached count does not extend its own expiration
+    assert db.count() == "10"
+    assert vdb.counts[("key", "default")][0] == expires
+    vdb.counts[("key", "default")] = (0.0, 10)
+    assert db.count() == "20"
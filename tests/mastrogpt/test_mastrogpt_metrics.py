@@ -0,0 +1,32 @@
+import balancer, meter, metrics
+
+def test_bucket():
+    assert meter.bucket("ttft_ms", 50) == "le:50"
+    assert meter.bucket("ttft_ms", 51) == "le:100"
+    assert meter.bucket("ttft_ms", 1e6) == "le:inf"
+
+def test_quantile():
+    hist = {"count": 10, "sum": 1000.0, "le:50": 5, "le:100": 4, "le:inf": 1}
+    assert metrics.quantile(hist, 0.5) == 50
+    assert metrics.quantile(hist, 0.9) == 100
+    assert metrics.quantile(hist, 0.95) == float("inf")
+    assert metrics.quantile({}, 0.5) == 0.0
+
+def test_metrics(args, redis, monkeypatch):
+    monkeypatch.setattr(metrics, "rd", redis)
+    monkeypatch.setattr(metrics, "prefix", "test:")
+    for _ in range(2):
+        lines = balancer.Lines(args, "generate", "llama3.1:8b", json={"model": "llama3.1:8b", "prompt": "hi"})
+        assert len(list(meter.Meter(args, "llama3.1:8b", lines))) == 21
+    # one ttft and 20 inter token latencies per generation
+    hist = metrics.load("llama3.1:8b", "ttft_ms")
+    assert hist["count"] == 2 and sum(v for (k, v) in hist.items() if k.startswith("le:")) == 2
+    assert metrics.load("llama3.1:8b", "itl_ms")["count"] == 40
+    assert metrics.load("llama3.1:8b", "tps")["count"] == 2
+
+    out = metrics.metrics({"input": "*"})["output"]
+    assert out.startswith("llama3.1:8b\n")
+    assert "ttft_ms     n=2 " in out and "itl_ms      n=40 " in out
+    assert metrics.metrics({"input": "mis"})["output"] == "No metrics."
+    assert metrics.metrics({"input": "!llama3.1:8b"})["output"] == "Reset 1 models."
+    assert metrics.metrics({"input": "*"})["output"] == "No metrics."
@@ -1,3 +1,4 @@
+import json
 import solution.chat.chat as m
 
 def test_chat():
@@ -9,3 +10,50 @@ def test_chat():
     args = {"input": "What is the capital of Italy, in English?"}
     res = m.chat(args)
     assert res["output"].find("Rome") != -1
+
+def test_batch():
+    args = {"batch": ["What is the capital of Italy, in English?", "What is the capital of France, in English?"], "concurrency": 2}
+    res = m.chat(args)
+    lines = res["output"].splitlines()
+    assert len(lines) == 3
+    assert lines[0].find("Rome") != -1
+    assert lines[1].find("Paris") != -1
+    assert lines[2].find('"prompts": 2') != -1
+
+def test_stream():
+    import socket, threading
+    server = socket.create_server(("127.0.0.1", 0))
+    frames = []
+    def accept():
+        conn, _ = server.accept()
+        with conn, conn.makefile("rb") as lines:
+            frames.extend(json.loads(line) for line in lines)
+    thread = threading.Thread(target=accept)
+    thread.start()
+    args = {"input": "What is the capital of Italy, in English?", "num_predict": 32,
+            "STREAM_HOST": "127.0.0.1", "STREAM_PORT": server.getsockname()[1]}
+    res = m.chat(args)
+    thread.join(10)
+    server.close()
+    assert res["streaming"]
+    assert res["output"].find("Rome") != -1
+    assert "".join(frame["output"] for frame in frames) == res["output"]
+
+def test_backends():
+    res = m.chat({"input": "!backends"})
+    assert res["output"].find(" up inflight: 0") != -1
+
+def test_options():
+    res = m.chat({"input": "What is the capital of Italy?", "num_predict": "ten"})
+    assert res["output"] == "Invalid num_predict: 'ten', expected an integer."
+    assert m.options({"num_predict": "32", "num_ctx": 2048}) == {"num_predict": 32, "num_ctx": 2048}
+
+def test_batch_invalid():
+    res = m.chat({"ndjson": '{"prompt": "hi"}\n{"prompt": '})
+    assert res["output"].startswith("Invalid ndjson line 2:")
+    res = m.chat({"batch": ["hi"], "concurrency": "many"})
+    assert res["output"] == "Invalid concurrency: 'many', expected a positive integer."
+    res = m.chat({"batch": ["hi"], "timeout": "-1"})
+    assert res["output"] == "Invalid timeout: '-1', expected a positive number."
+    res = m.chat({"batch": [1]})
+    assert res["output"] == "Invalid prompt 0: 1, expected a string or an object."
@@ -4,3 +4,27 @@ def test_models():
     args = {}
     res = m.models(args)
     assert res["output"].find("llama") != -1
+
+def test_details():
+    args = {"details": True, "sort": "size"}
+    res = m.models(args)
+    rows = [line.split("\t") for line in res["output"].splitlines()]
+    assert len(rows) > 0
+    assert all(len(row) == 4 for row in rows)
+    assert any(row[0].find("llama") != -1 for row in rows)
+
+def test_details_errors(monkeypatch):
+    import fakeollama
+    (server, url) = fakeollama.start()
+    monkeypatch.setattr(m, "details_cache", {})
+    models = [(url, {"name": "llama3.1:8b", "digest": "d1"}), (url, {"name": "gone:1b", "digest": "d2"}),
+              ("http://127.0.0.1:1", {"name": "down:1b", "digest": "d3"}), (url, {"name": "mistral:7b"})]
+    rows = m.details(models)
+    assert [row["name"] for row in rows] == ["llama3.1:8b", "gone:1b", "down:1b", "mistral:7b"]
+    # a model that cannot be shown is blank, the others are still listed
+    assert rows[0]["parameter_size"] == "8.0B"
+    assert rows[1]["parameter_size"] == rows[2]["parameter_size"] == ""
+    assert rows[3]["parameter_size"] == "7.0B"
+    # only the details found of a model with a digest are cached
+    assert list(m.details_cache) == ["d1"]
+    server.shutdown()